@@ -7,4 +7,7 @@ from ._version import get_versions
 __version__ = get_versions()['version']
 del get_versions
 
+from .clocks import *
 from .limiter import *
+from .storages import *
+from .strategies import *
@@ -0,0 +1,27 @@
+"""Clocks which can be used by the limiter."""
+
+
+class VirtualClock(object):
+    """
+    Clock which only moves when it is advanced, so tests and benchmarks don't need to sleep.
+
+    """
+
+    def __init__(self, now=0):
+        """
+        Args:
+            now (int): Initial time in nanoseconds.
+
+        """
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        """
+        Args:
+            seconds (float): Seconds the clock moves forward.
+
+        """
+        self.now += round(seconds * 10 ** 9)
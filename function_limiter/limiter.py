@@ -1,16 +1,27 @@
 """Function-Limiter Extension for limiting callable functions."""
 import asyncio
-import json
 import re
-import time
-from contextlib import suppress
-from functools import wraps
+import struct
+from functools import cached_property, lru_cache, wraps
+from math import ceil
 
-import redis
+from .storages import AsyncRedisStorage, MemoryStorage, RedisStorage
+from .strategies import strategies
 
 
 class RateLimitExceeded(Exception):
-    pass
+    def __init__(self, retry_after=None):
+        """
+        Args:
+            retry_after (float|None): Seconds until the next call is permitted, if the strategy can tell.
+
+        """
+        if retry_after is None:
+            super().__init__()
+        else:
+            super().__init__('Retry after {:.3f} seconds'.format(retry_after))
+
+        self.retry_after = retry_after
 
 
 time_periods = {
@@ -23,131 +34,176 @@ time_periods = {
     'year': 60 * 60 * 24 * 365,
 }
 
+limitation_pattern = re.compile(r'(\d+(?:\.\d+)?)/(\d*)(second|minute|hour|day|week|month|year)')
 
-class Limiter(object):
-    __database_name = 'function-limiter'
-    __limiter_keys = list()
 
-    def __init__(self, redis_storage=None, default_limitations=None, default_key=None, default_exempt=None,
-                 database_name=None):
-        """
-        Args:
-            redis_storage (redis.Redis): Redis storage.
-            default_limitations (str|function|None): Global limitations
-            default_key (str|function|None): Global limitations key
-            default_exempt (str|function|None): Exempt key used to decide if the rate limit should skipped.
+class Policy(tuple):
+    """Compiled limitations, a tuple of ``(count, period)`` pairs where period is in seconds."""
 
+    @cached_property
+    def period(self):
         """
-        if database_name is not None:
-            self.__database_name = database_name
-
-        if redis_storage:
-            self.redis_storage = redis_storage
-
-            if not self.redis_storage.exists(self.__database_name):
-                self.logs = self.redis_storage.set(self.__database_name, '{}')
+        Returns:
+            int: Longest period of the policy in seconds, 0 if there isn't any limitation.
 
-            self.logs = json.loads(self.redis_storage.get(self.__database_name).decode())
+        """
+        return max((period for _, period in self), default=0)
 
-        else:
-            self.redis_storage = None
-            self.logs = dict()
+    @cached_property
+    def windows(self):
+        """
+        Returns:
+            tuple: ``(count, period)`` pairs where period is in nanoseconds.
 
-        self.default_limitations = default_limitations
-        self.default_key = default_key
-        self.default_exempt = default_exempt
+        """
+        return tuple((limit_count, period * 10 ** 9) for limit_count, period in self)
 
-    @staticmethod
-    def __validate_limitations(limitations):
+    @cached_property
+    def capacity(self):
         """
         Returns:
-            bool: True if it is valid string, False if it isn't
+            int: Most calls any limitation of the policy permits, 0 if there isn't any limitation.
 
         """
-        if not isinstance(limitations, str):
-            return False
+        return max((ceil(limit_count) for limit_count, _ in self), default=0)
 
-        if limitations[-1] != ';':  # If limitations doesn't end with `;`
-            limitations += ';'  # Add `;` to end of the string
 
-        # Check limitation must fallow `count per period;`
-        regex_string = r'((?:\d+(?:.\d+)?)(?:\/| per )(\d*)(?:second|minute|hour|day|week|month|year)(?:;|,))'
+@lru_cache(maxsize=1024)
+def _parse_limitations(limitations):
+    limitations = limitations.replace('per', '/')
+    limitations = limitations.replace(' ', '')
+    limitations = limitations.replace(',', ';')
 
-        regex = re.compile(regex_string)
+    pairs = list()
 
-        return bool(regex.match(limitations))
+    for limitation in filter(None, limitations.split(';')):
+        match = limitation_pattern.fullmatch(limitation)
 
-    def __garbage_collector(self, limitations, key):
-        """
-        Args:
-            limitations (str|function): Limitations wanted to apply.
-            key (str|function): Key which specifies the limitation.
+        if match is None:
+            return Policy()
+
+        limit_count, multiplier, period = match.groups()
+        limit_count = float(limit_count) if '.' in limit_count else int(limit_count)
+
+        pairs.append((limit_count, int(multiplier or 1) * time_periods[period]))
+
+    return Policy(pairs)
+
+
+def compile_limitations(limitations):
+    """
+    Args:
+        limitations (str|Policy): Limitations like ``'3/second;10 per minute'``.
+
+    Returns:
+        Policy: Compiled limitations, empty policy if limitations isn't valid.
+
+    """
+    if isinstance(limitations, Policy):
+        return limitations
+
+    if not isinstance(limitations, str):
+        return Policy()
+
+    return _parse_limitations(limitations)
+
+
+state_record = struct.Struct('<qqBHI')
 
-        """
-        passed_log = list()
 
-        for limitation in limitations.split(';'):
-            # limit_count, limit_time = limitation.split('/')
-            limit_time = limitation.split('/')[1]
-            period = time_periods[limit_time]
-            garbage_set = set()
+def read_records(file):
+    """
+    Args:
+        file (typing.BinaryIO): File the records of ``Limiter.export_state`` are written to one after another.
 
-            for tick in self.logs[key]:
-                if time.time() - tick >= period:
-                    garbage_set.add(tick)
+    Yields:
+        bytes: Record of a key.
 
-            passed_log.append(garbage_set)
+    """
+    while True:
+        header = file.read(state_record.size)
 
-        for item in list(set.intersection(*passed_log)):
-            self.logs[key].remove(item)
+        if len(header) < state_record.size:
+            return
 
-    def __evaluate_limitations(self, limitations, key):
+        _, _, name_length, key_length, length = state_record.unpack(header)
+
+        yield header + file.read(name_length + key_length + length)
+
+
+class Limiter(object):
+    __limiter_keys = list()
+
+    def __init__(self, redis_storage=None, default_limitations=None, default_key=None, default_exempt=None,
+                 database_name=None, strategy='sliding-log', max_keys=None, idle_ttl=None, clock=None, lease=None,
+                 lease_ttl=1, storage=None, invalidation=None):
         """
         Args:
-            limitations (str|function): Limitations wanted to apply.
-            key (str|function): Key which specifies the limitation.
-
-        Returns:
-            bool: True if it permitted, False if otherwise
+            redis_storage (redis.Redis|redis.cluster.RedisCluster|redis.asyncio.Redis): Redis storage, an asyncio
+                client can only limit coroutine functions.
+            default_limitations (str|function|None): Global limitations
+            default_key (str|function|None): Global limitations key
+            default_exempt (str|function|None): Exempt key used to decide if the rate limit should skipped.
+            database_name (str|None): Name of the database which keeps the logs.
+            strategy (str|Strategy): Rate limiting algorithm, one of ``function_limiter.strategies`` keys.
+            max_keys (int|None): Most keys the in-memory storage keeps, least recently used keys are evicted first.
+            idle_ttl (float|None): Seconds an idle key is kept in the in-memory storage, until its state is fully
+                expired if it isn't defined.
+            clock (function|None): Clock which returns the current time in nanoseconds, the clock of the storage,
+                ``time.monotonic_ns`` in memory and ``time.time_ns`` on Redis, if it isn't defined.
+            lease (float|None): Most share of the smallest limitation count a lease of the Redis storage takes, leases
+                are disabled if it isn't defined. Only strategies which define ``lease_script`` are leased.
+            lease_ttl (float): Seconds a lease is spent locally before its unused permits are given back.
+            storage (Storage|None): Storage which keeps the state of the keys, built from ``redis_storage`` or the
+                in-memory options if it isn't defined.
+            invalidation (bool|None): Whether resets are published to, and leases are invalidated by, the other
+                Redis storages of the database, whenever ``lease`` is defined if it isn't defined.
 
         """
+        if storage is None and redis_storage is None:
+            storage = MemoryStorage(max_keys, idle_ttl)
 
-        limitations = limitations.replace('per', '/')
-        limitations = limitations.replace(' ', '')
-        limitations = limitations.replace(',', ';')
+        elif storage is None:
+            options = dict(
+                lease=lease, lease_ttl=lease_ttl, invalidation=bool(lease) if invalidation is None else invalidation
+            )
 
-        if not self.__validate_limitations(limitations):
-            return True
+            if database_name is not None:
+                options['database_name'] = database_name
 
-        # self.__garbage_collector(limitations, key)
+            if asyncio.iscoroutinefunction(getattr(redis_storage, 'execute_command', None)):
+                storage = AsyncRedisStorage(redis_storage, **options)
+            else:
+                storage = RedisStorage(redis_storage, **options)
 
-        for limitation in limitations.split(';'):
-            limit_count, limit_time = limitation.split('/')
-            limit_count = int(limit_count)
+        self.redis_storage = redis_storage
+        self.storage = storage
+        self.clock = clock or storage.clock
 
-            for period in time_periods.keys():
-                if period in limit_time:
-                    if limit_time.removesuffix(period) == '':
-                        oscillation = time_periods[limit_time]
-                    else:
-                        oscillation = int(limit_time.removesuffix(period)) * time_periods[period]
-            lap = 0
+        if not (default_limitations is None or callable(default_limitations)):
+            default_limitations = compile_limitations(default_limitations)
 
-            for tick in self.logs[key]:
-                if time.time() - tick < oscillation:
-                    lap += 1
+        self.strategy = strategies[strategy] if isinstance(strategy, str) else strategy
+        self.default_limitations = default_limitations
+        self.default_key = default_key
+        self.default_exempt = default_exempt
 
-            if limit_count <= lap:
-                return False
+    @property
+    def logs(self):
+        """
+        Returns:
+            dict|None: State of each key kept in memory, None if the storage doesn't keep it.
 
-        return True
+        """
+        return getattr(self.storage, 'logs', None)
 
-    def limit(self, limitations=None, key=None, exempt=None):
+    def limit(self, limitations=None, key=None, exempt=None, strategy=None):
         """
         Args:
             limitations (str|function|NoneType): Limitations wanted to apply.
             key (str|function|NoneType): Key which specifies the limitation.
             exempt (str|function|NoneType): Exempt key used to decide if the rate limit should skipped.
+            strategy (str|Strategy|NoneType): Rate limiting algorithm, the limiter's strategy if it isn't defined.
 
         Raises:
             RateLimitExceeded (RateLimitExceeded): When callable function reached the limitations.
@@ -157,32 +213,49 @@ class Limiter(object):
 
         """
 
+        if not (limitations is None or callable(limitations)):
+            limitations = compile_limitations(limitations)
+
+        strategy = self.__strategy(strategy)
+
         def decorator(function):
             if asyncio.iscoroutinefunction(function):
                 @wraps(function)
                 async def wrapper(*args, **kwargs):
-                    self.__limitation_check(limitations, key, exempt)
+                    await self.__async_limitation_check(limitations, key, exempt, strategy)
                     return await function(*args, **kwargs)
+            elif self.storage.asynchronous:
+                raise TypeError('Asyncio Redis storage can only limit coroutine functions')
             else:
                 @wraps(function)
                 def wrapper(*args, **kwargs):
-                    self.__limitation_check(limitations, key, exempt)
+                    self.__limitation_check(limitations, key, exempt, strategy)
                     return function(*args, **kwargs)
 
             return wrapper
 
         return decorator
 
-    def __limitation_check(self, limitations, key, exempt):
-        if self.redis_storage:
-            self.logs = json.loads(self.redis_storage.get(self.__database_name).decode())
+    def __resolve(self, limitations, key, exempt):
+        """
+        Args:
+            limitations (Policy|function|NoneType): Limitations wanted to apply.
+            key (str|function|NoneType): Key which specifies the limitation.
+            exempt (str|function|NoneType): Exempt key used to decide if the rate limit should skipped.
+
+        Returns:
+            tuple|None: Key and compiled limitations, None if the call isn't limited.
 
+        """
         _key = key() if callable(key) else key
         _limitations = limitations() if callable(limitations) else limitations
         _exempt = exempt() if callable(exempt) else exempt
 
         if _limitations is None and self.default_limitations:
-            _limitations = self.default_limitations
+            _limitations = self.default_limitations() if callable(self.default_limitations) else \
+                self.default_limitations
+
+        _limitations = compile_limitations(_limitations)
 
         if _key is None and self.default_key:
             _key = self.default_key
@@ -190,37 +263,226 @@ class Limiter(object):
         if exempt is None and self.default_exempt:
             _exempt = self.default_exempt
 
-        if not (_key is None or _key == _exempt):
-            # self.__limiter_keys.append(_key)
-            # if self.__limiter_keys.count(_key) <= 1:
+        if _key is None or _key == _exempt:
+            return None
 
-            if _key not in self.logs:
-                self.logs[_key] = list()
+        return _key, _limitations
 
-            if not self.__evaluate_limitations(_limitations, _key):
-                raise RateLimitExceeded
+    def __limitation_check(self, limitations, key, exempt, strategy):
+        resolved = self.__resolve(limitations, key, exempt)
 
-            self.logs[_key].append(time.time())
+        if resolved is not None:
+            # self.__limiter_keys.append(_key)
+            # if self.__limiter_keys.count(_key) <= 1:
 
-            if self.redis_storage:
-                self.redis_storage.set(self.__database_name, json.dumps(self.logs))
+            self.__verdict(*self.storage.acquire(*resolved, strategy, self.clock()))
 
             # if self.__limiter_keys.__len__() > 0:
             #     self.__limiter_keys.pop(0)
 
+    async def __async_limitation_check(self, limitations, key, exempt, strategy):
+        resolved = self.__resolve(limitations, key, exempt)
+
+        if resolved is None:
+            return
+
+        decision = self.storage.acquire(*resolved, strategy, self.clock())
+
+        if self.storage.asynchronous:
+            decision = await decision
+
+        self.__verdict(*decision)
+
+    @staticmethod
+    def __verdict(permitted, retry_after):
+        """
+        Args:
+            permitted (bool): Whether the storage permitted the call.
+            retry_after (int|None): Nanoseconds until the next call is permitted, None if the strategy can't tell.
+
+        Raises:
+            RateLimitExceeded (RateLimitExceeded): When the key reached the limitations.
+
+        """
+        if not permitted:
+            raise RateLimitExceeded(None if retry_after is None else retry_after / 10 ** 9)
+
     def reset(self, key):
         """
             Args:
                 key (str|function|NoneType): Key which specifies the limitation.
+
+            Returns:
+                typing.Awaitable|None: Deletion which should be awaited on an asyncio Redis storage.
         """
 
         _key = key() if callable(key) else key
+        deletion = self.storage.reset(_key)
+
+        if self.storage.asynchronous:
+            return deletion
+
+    def reset_many(self, keys):
+        """
+            Args:
+                keys (typing.Iterable[str|function]): Keys which specify the limitations.
+
+            Returns:
+                typing.Awaitable|None: Deletion which should be awaited on an asyncio Redis storage.
+        """
+
+        deletion = self.storage.reset_many([key() if callable(key) else key for key in keys])
+
+        if self.storage.asynchronous:
+            return deletion
+
+    def reset_matching(self, pattern):
+        """
+            Args:
+                pattern (str): Glob style pattern of the keys, like ``'tenant-*'``.
+
+            Returns:
+                typing.Awaitable|int: Number of keys which are reset, which should be awaited on an asyncio Redis
+                    storage.
+        """
+
+        return self.storage.reset_matching(pattern)
+
+    def export_state(self, strategy=None):
+        """
+        Streams the keys which aren't expired one by one, each in a compact record of the time it's exported, the time
+        it expires, the name of its strategy, the key and its state packed by the strategy.
+
+        Args:
+            strategy (str|Strategy|NoneType): Rate limiting algorithm whose keys are exported, the keys of the limiter's
+                strategy and of the registered strategies if it isn't defined.
+
+        Returns:
+            typing.Iterator[bytes]|typing.AsyncIterator[bytes]: Records of the keys, asynchronous on an asyncio Redis
+                storage.
+
+        """
+        now = self.clock()
+        states = self.storage.export_states(self.__strategies(strategy), now)
+
+        if self.storage.asynchronous:
+            return self.__async_records(states, now)
+
+        return (self.__record(key, strategy, state, deadline, now) for key, strategy, state, deadline in states)
+
+    def import_state(self, records, strategy=None):
+        """
+        Imports the records of ``export_state`` one by one, each state is decoded by the strategy named in its record
+        and rebased from the time it's exported to the current time, so the records can move between clocks. Expired
+        records and the records of unknown strategies are skipped.
+
+        Args:
+            records (typing.Iterable[bytes]|typing.AsyncIterable[bytes]): Records of the keys, asynchronous ones only on
+                an asyncio Redis storage.
+            strategy (str|Strategy|NoneType): Rate limiting algorithm whose records are imported, the records of the
+                limiter's strategy and of the registered strategies if it isn't defined.
+
+        Returns:
+            typing.Awaitable|None: Import which should be awaited on an asyncio Redis storage.
+
+        """
+        known = self.__strategies(strategy)
+        now = self.clock()
+
+        if hasattr(records, '__aiter__'):
+            states = self.__async_states(records, known, now)
+        else:
+            states = (self.__state(record, known, now) for record in records)
+            states = (state for state in states if state is not None)
+
+        return self.storage.import_states(states, now)
+
+    def __strategy(self, strategy):
+        """
+        Args:
+            strategy (str|Strategy|NoneType): Rate limiting algorithm, the limiter's strategy if it isn't defined.
+
+        Returns:
+            Strategy: Rate limiting algorithm.
+
+        """
+        if strategy is None:
+            return self.strategy
+
+        if isinstance(strategy, str):
+            return strategies[strategy]
+
+        return strategy
+
+    def __strategies(self, strategy):
+        """
+        Args:
+            strategy (str|Strategy|NoneType): Rate limiting algorithm, the limiter's strategy and the registered
+                strategies if it isn't defined.
+
+        Returns:
+            dict: Rate limiting algorithms by their name.
+
+        """
+        if strategy is None:
+            return dict(strategies, **{self.strategy.name: self.strategy})
+
+        strategy = self.__strategy(strategy)
+
+        return {strategy.name: strategy}
+
+    @staticmethod
+    def __record(key, strategy, state, deadline, now):
+        """
+        Args:
+            key (str): Key which specifies the limitation.
+            strategy (Strategy): Rate limiting algorithm the key is limited by.
+            state (object): State of the key.
+            deadline (int): Time in nanoseconds when the state expires.
+            now (int): Time in nanoseconds when the key is exported.
+
+        Returns:
+            bytes: Record of the key.
+
+        """
+        name = strategy.name.encode()
+        key = str(key).encode()
+        data = strategy.encode(state)
+
+        return state_record.pack(now, deadline, len(name), len(key), len(data)) + name + key + data
+
+    @staticmethod
+    def __state(record, known, now):
+        """
+        Args:
+            record (bytes): Record of the key.
+            known (dict): Rate limiting algorithms by their name.
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            tuple|None: Key, the strategy it's limited by, its state and the time in nanoseconds it expires, None if
+                it's expired or its strategy isn't known.
+
+        """
+        exported, deadline, name_length, key_length, length = state_record.unpack_from(record)
+        position = state_record.size + name_length
+        strategy = known.get(bytes(record[state_record.size:position]).decode())
+
+        if deadline <= exported or strategy is None:
+            return None
+
+        key = bytes(record[position:position + key_length]).decode()
+        data = bytes(record[position + key_length:position + key_length + length])
+
+        return key, strategy, strategy.rebase(strategy.decode(data), exported, now), deadline - exported + now
 
-        if self.redis_storage:
-            self.logs = json.loads(self.redis_storage.get(self.__database_name).decode())
+    async def __async_records(self, states, now):
+        async for key, strategy, state, deadline in states:
+            yield self.__record(key, strategy, state, deadline, now)
 
-        with suppress(KeyError):
-            del self.logs[_key]
+    async def __async_states(self, records, known, now):
+        async for record in records:
+            state = self.__state(record, known, now)
 
-        if self.redis_storage:
-            self.redis_storage.set(self.__database_name, json.dumps(self.logs))
+            if state is not None:
+                yield state
@@ -0,0 +1,2015 @@
+"""Storages which keep the state of the limited keys and decide their calls."""
+import asyncio
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, suppress
+from copy import deepcopy
+from fnmatch import fnmatchcase
+from hashlib import blake2b
+from heapq import heappop, heappush
+from itertools import count, islice
+from math import ceil
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from uuid import uuid4
+
+with suppress(ImportError):
+    import fcntl
+
+
+class Storage(object):
+    """
+    Storage of the limiter, which keeps the state of each key and decides whether a call of the key is permitted.
+
+    Each storage makes the decision atomic in its own way, ``acquire`` decides and records the call while ``peek``
+    only decides it. Storages of an asyncio client set ``asynchronous``, and their methods return awaitables.
+
+    """
+    asynchronous = False
+    clock = staticmethod(time.monotonic_ns)
+
+    def acquire(self, key, policy, strategy, now):
+        """
+        Args:
+            key (str): Key which specifies the limitation.
+            policy (Policy): Compiled limitations wanted to apply.
+            strategy (Strategy): Rate limiting algorithm.
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            tuple: Whether the call is permitted, and the nanoseconds until the next call is permitted, None if the
+                strategy can't tell.
+
+        """
+        raise NotImplementedError
+
+    def peek(self, key, policy, strategy, now):
+        """
+        Args:
+            key (str): Key which specifies the limitation.
+            policy (Policy): Compiled limitations wanted to apply.
+            strategy (Strategy): Rate limiting algorithm.
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            bool: Whether a call would be permitted, the call isn't recorded.
+
+        """
+        raise NotImplementedError
+
+    def reset(self, key):
+        """
+        Args:
+            key (str): Key which specifies the limitation.
+
+        """
+        raise NotImplementedError
+
+    def reset_many(self, keys):
+        """
+        Args:
+            keys (typing.Iterable[str]): Keys which specify the limitations.
+
+        """
+        for key in keys:
+            self.reset(key)
+
+    def reset_matching(self, pattern):
+        """
+        Args:
+            pattern (str): Glob style pattern of the keys, like ``'tenant-*'``.
+
+        Returns:
+            int: Number of keys which are reset.
+
+        """
+        raise NotImplementedError
+
+    def export_states(self, strategies, now):
+        """
+        Args:
+            strategies (dict): Rate limiting algorithms by their name, the keys of the other strategies are skipped.
+            now (int): Current time in nanoseconds.
+
+        Yields:
+            tuple: Key, the strategy it's limited by, its state and the time in nanoseconds it expires, the expired
+                keys are skipped.
+
+        """
+        raise NotImplementedError
+
+    def import_states(self, states, now):
+        """
+        Args:
+            states (typing.Iterable[tuple]): Keys, the strategies they're limited by, their states and the times in
+                nanoseconds they expire.
+            now (int): Current time in nanoseconds.
+
+        """
+        raise NotImplementedError
+
+    def ping(self):
+        """
+        Returns:
+            bool: Whether the storage is reachable, raises if it isn't.
+
+        """
+        return True
+
+
+class MemoryStorage(Storage):
+    """
+    Storage which keeps the state of each key in the process.
+
+    The keys are spread over ``stripes`` stripes by their hash. Each stripe has its own lock, its keys in least recently
+    used order, and its keys queued by the time they expire, one queue per time to live, where a key moves to the end
+    whenever its deadline is pushed back. Each queue is in deadline order, so expired keys are evicted from the front of
+    the queues whatever order they were used in. Imported keys have no time to live of their own, they're kept in a
+    heap by their deadline until they're used.
+
+    It's safe to share between threads, and a decision only holds the lock of its stripe, so threads only wait for the
+    keys which share their stripe. A decision evicts the expired keys of its stripe, and the other stripes are swept at
+    most every ``sweep_interval`` nanoseconds, skipping the ones which are busy. Over ``max_keys`` keys, the least
+    recently used key at the front of the stripes is evicted.
+
+    ``logs`` maps each key to its state, in the order the keys are created.
+
+    """
+    sweep_interval = 10 ** 7
+
+    def __init__(self, max_keys=None, idle_ttl=None, stripes=64):
+        """
+        Args:
+            max_keys (int|None): Most keys the storage keeps, least recently used keys are evicted first.
+            idle_ttl (float|None): Seconds an idle key is kept, until its state is fully expired if it isn't defined.
+            stripes (int): Number of stripes the keys are spread over.
+
+        """
+        self.logs = dict()
+        self.max_keys = max_keys
+        self.idle_ttl = idle_ttl
+        self.__stripes = tuple(_Stripe() for _ in range(stripes))
+        self.__swept = None
+        self.__order = count()
+
+    def acquire(self, key, policy, strategy, now):
+        stripe = self.__stripe(key)
+
+        with stripe.lock:
+            entry = stripe.keys.get(key)
+            created = entry is None
+
+            if created:
+                entry = stripe.keys[key] = _Entry(strategy.create(policy), strategy.name)
+                self.logs[key] = entry.state
+                self.__expire(stripe, key, entry, now + strategy.ttl(policy), strategy.ttl(policy))
+            else:
+                stripe.keys.move_to_end(key)
+
+            entry.used = now
+
+            if self.idle_ttl is not None:
+                ttl = round(self.idle_ttl * 10 ** 9)
+                self.__expire(stripe, key, entry, now + ttl, ttl)
+
+            self.__evict(stripe, now, key)
+            permitted = strategy.hit(entry.state, policy, now)
+
+            if not permitted:
+                decision = False, strategy.retry_after(entry.state, policy, now)
+            else:
+                decision = True, None
+
+                if self.idle_ttl is None:
+                    self.__expire(stripe, key, entry, now + strategy.ttl(policy), strategy.ttl(policy))
+
+        self.__maintain(key, now, created)
+
+        return decision
+
+    def peek(self, key, policy, strategy, now):
+        stripe = self.__stripe(key)
+
+        with stripe.lock:
+            entry = stripe.keys.get(key)
+            state = strategy.create(policy) if entry is None else deepcopy(entry.state)
+
+        return strategy.hit(state, policy, now)
+
+    def reset(self, key):
+        stripe = self.__stripe(key)
+
+        with stripe.lock:
+            self.__forget(stripe, key)
+
+    def reset_matching(self, pattern):
+        keys = [key for key in list(self.logs) if fnmatchcase(str(key), pattern)]
+        self.reset_many(keys)
+
+        return len(keys)
+
+    def export_states(self, strategies, now):
+        for key in list(self.logs):
+            stripe = self.__stripe(key)
+
+            with stripe.lock:
+                entry = stripe.keys.get(key)
+                strategy = None if entry is None else strategies.get(entry.strategy)
+                state = None if strategy is None else deepcopy(entry.state)
+                deadline = 0 if entry is None else entry.deadline
+
+            if state is not None and deadline > now:
+                yield key, strategy, state, deadline
+
+    def import_states(self, states, now):
+        for key, strategy, state, deadline in states:
+            stripe = self.__stripe(key)
+
+            with stripe.lock:
+                entry = stripe.keys.get(key)
+                created = entry is None
+
+                if created:
+                    entry = stripe.keys[key] = _Entry(state, strategy.name)
+                else:
+                    entry.state = state
+                    entry.strategy = strategy.name
+                    stripe.keys.move_to_end(key)
+
+                entry.used = now
+                self.logs[key] = state
+                self.__expire(stripe, key, entry, deadline, None)
+                self.__evict(stripe, now, key)
+
+            self.__maintain(key, now, created)
+
+    def __stripe(self, key):
+        """
+        Args:
+            key (str): Key which specifies the limitations.
+
+        Returns:
+            _Stripe: Stripe the key is kept in.
+
+        """
+        return self.__stripes[hash(key) % len(self.__stripes)]
+
+    def __maintain(self, key, now, created):
+        """
+        Sweeps the other stripes once ``sweep_interval`` passed, and keeps at most ``max_keys`` keys after a key is
+        created. It's called without any lock held.
+
+        Args:
+            key (str): Key which was just decided, it's never evicted.
+            now (int): Current time in nanoseconds.
+            created (bool): Whether the key was created.
+
+        """
+        if self.__swept is None or now - self.__swept >= self.sweep_interval:
+            self.__swept = now
+
+            for stripe in self.__stripes:
+                if stripe.lock.acquire(blocking=False):
+                    try:
+                        self.__evict(stripe, now, key)
+                    finally:
+                        stripe.lock.release()
+
+        if created and self.max_keys is not None:
+            while sum(len(stripe.keys) for stripe in self.__stripes) > max(self.max_keys, 1):
+                if not self.__evict_oldest(key):
+                    break
+
+    def __evict_oldest(self, keep):
+        """
+        Args:
+            keep (str): Key which is never evicted.
+
+        Returns:
+            bool: Whether the least recently used key at the front of the stripes is evicted, the stripes which are
+                busy are skipped.
+
+        """
+        oldest = None
+
+        for stripe in self.__stripes:
+            if stripe.lock.acquire(blocking=False):
+                try:
+                    front = next((key for key in stripe.keys if key != keep), None)
+
+                    if front is not None and (oldest is None or stripe.keys[front].used < oldest[2]):
+                        oldest = stripe, front, stripe.keys[front].used
+                finally:
+                    stripe.lock.release()
+
+        if oldest is None:
+            return False
+
+        stripe, key, used = oldest
+
+        with stripe.lock:
+            entry = stripe.keys.get(key)
+
+            if entry is not None and entry.used == used:
+                self.__forget(stripe, key)
+
+        return True
+
+    def __expire(self, stripe, key, entry, deadline, ttl):
+        """
+        Moves the key to the end of the queue of its time to live, or pushes it on the heap of the imported keys. It's
+        called under the lock of the stripe.
+
+        Args:
+            stripe (_Stripe): Stripe of the key.
+            key (str): Key which specifies the limitations.
+            entry (_Entry): Entry of the key.
+            deadline (int): Time in nanoseconds when the key expires.
+            ttl (int|None): Nanoseconds the deadline is after the last call, None for imported keys.
+
+        """
+        if entry.ttl != ttl:
+            self.__dequeue(stripe, key, entry.ttl)
+
+        entry.deadline = deadline
+        entry.ttl = ttl
+
+        if ttl is None:
+            heappush(stripe.imported, (deadline, next(self.__order), key))
+            return
+
+        queue = stripe.queues.get(ttl)
+
+        if queue is None:
+            queue = stripe.queues[ttl] = OrderedDict()
+
+        queue[key] = entry
+        queue.move_to_end(key)
+
+    @staticmethod
+    def __dequeue(stripe, key, ttl):
+        """
+        Args:
+            stripe (_Stripe): Stripe of the key.
+            key (str): Key which specifies the limitations.
+            ttl (int|None): Time to live of the queue the key is in, the entries of the heap of the imported keys are
+                dropped once they're popped.
+
+        """
+        queue = stripe.queues.get(ttl)
+
+        if queue is not None:
+            queue.pop(key, None)
+
+            if not queue:
+                del stripe.queues[ttl]
+
+    def __forget(self, stripe, key):
+        """
+        Args:
+            stripe (_Stripe): Stripe of the key.
+            key (str): Key which specifies the limitations, dropped with its deadline.
+
+        """
+        entry = stripe.keys.pop(key, None)
+
+        if entry is not None:
+            self.logs.pop(key, None)
+            self.__dequeue(stripe, key, entry.ttl)
+
+    def __evict(self, stripe, now, keep):
+        """
+        Evicts the expired keys from the front of the queues and the heap of the imported keys of the stripe. It's
+        called under the lock of the stripe.
+
+        Args:
+            stripe (_Stripe): Stripe of the keys.
+            now (int): Current time in nanoseconds.
+            keep (str): Key which was just decided, it's never evicted.
+
+        """
+        for queue in list(stripe.queues.values()):
+            while queue:
+                key, entry = next(iter(queue.items()))
+
+                if key == keep or entry.deadline > now:
+                    break
+
+                self.__forget(stripe, key)
+
+        while stripe.imported and stripe.imported[0][0] <= now:
+            deadline, _, key = stripe.imported[0]
+            entry = stripe.keys.get(key)
+            current = entry is not None and entry.ttl is None and entry.deadline == deadline
+
+            if current and key == keep:
+                break
+
+            heappop(stripe.imported)
+
+            if current:
+                self.__forget(stripe, key)
+
+
+class _Stripe(object):
+    """
+    Keys of a ``MemoryStorage`` which share a lock.
+
+    """
+    __slots__ = ('lock', 'keys', 'queues', 'imported')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = OrderedDict()
+        self.queues = dict()
+        self.imported = list()
+
+
+class _Entry(object):
+    """
+    State of a key of a ``MemoryStorage``, with the name of its strategy, the time it was last used and the time it
+    expires.
+
+    """
+    __slots__ = ('state', 'strategy', 'used', 'deadline', 'ttl')
+
+    def __init__(self, state, strategy):
+        """
+        Args:
+            state (object): State of the key.
+            strategy (str): Name of the rate limiting algorithm the key is limited by.
+
+        """
+        self.state = state
+        self.strategy = strategy
+        self.used = 0
+        self.deadline = 0
+        self.ttl = -1
+
+
+class SlotTableStorage(Storage):
+    """
+    Storage which keeps the state of the keys in a table of ``slots`` fixed size slots on a shared buffer, so the
+    processes of one host share their limitations without a network hop.
+
+    A key hashes to a window of ``probes`` slots, and it takes the first empty or expired slot of the window, or the
+    one which expires first if the window is full. Each slot keeps the fingerprint of its key, the time its state
+    expires, the length of the key and up to ``key_size`` bytes of it, up to 16 bytes of the name of its strategy, and
+    the state packed by the strategy, which has to fit ``slot_size`` bytes. A sliding log takes eight bytes per tick,
+    and a policy whose state may not fit is refused up front.
+
+    The window is locked by an ``fcntl`` byte-range lock, so processes only wait for the keys which share their window,
+    and the threads of a process take turns. It needs a POSIX host.
+
+    """
+    header = struct.Struct('<QqHI16s')
+
+    def __init__(self, buffer, origin, descriptor, slots, slot_size, key_size, probes):
+        """
+        Args:
+            buffer (memoryview): Buffer which keeps the table.
+            origin (int): Offset of the table in the buffer.
+            descriptor (int): File descriptor the byte-range locks are taken on, the byte after a slot's index locks
+                it.
+            slots (int): Number of slots of the table, the most keys it keeps.
+            slot_size (int): Most bytes of the packed state of a key.
+            key_size (int): Most bytes of a key kept for ``reset_matching``, longer keys are matched by their prefix.
+            probes (int): Number of slots a key may take.
+
+        """
+        self.buffer = buffer
+        self.origin = origin
+        self.slots = slots
+        self.slot_size = slot_size
+        self.key_size = key_size
+        self.probes = min(probes, slots)
+        self.stride = self.slot_stride(slot_size, key_size)
+        self.__descriptor = descriptor
+        self.__sizes = dict()
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def slot_stride(cls, slot_size, key_size):
+        """
+        Args:
+            slot_size (int): Most bytes of the packed state of a key.
+            key_size (int): Most bytes of a key.
+
+        Returns:
+            int: Bytes a slot takes, aligned to eight bytes.
+
+        """
+        return -(-(cls.header.size + key_size + slot_size) // 8) * 8
+
+    def acquire(self, key, policy, strategy, now):
+        """
+        Raises:
+            ValueError (ValueError): When a state of the policy may not fit the slot, before the key is changed.
+
+        """
+        size = self.__sizes.get((strategy, policy))
+
+        if size is None:
+            size = self.__sizes[strategy, policy] = strategy.size(policy)
+
+        if size > self.slot_size:
+            raise ValueError(
+                'State of up to {} bytes does not fit the {} bytes slot, use a larger slot_size or a counter '
+                'strategy'.format(size, self.slot_size)
+            )
+
+        key = str(key).encode()
+        fingerprint, start = self.__hash(key)
+
+        with self.__locked(start, self.probes):
+            offset, data, deadline = self.__find(fingerprint, start, now)
+            state = strategy.create(policy) if data is None else strategy.decode(data)
+
+            if strategy.hit(state, policy, now):
+                decision = True, None
+                deadline = now + strategy.ttl(policy)
+            else:
+                decision = False, strategy.retry_after(state, policy, now)
+
+            self.__write(offset, fingerprint, deadline, key, strategy, strategy.encode(state))
+
+        return decision
+
+    def peek(self, key, policy, strategy, now):
+        fingerprint, start = self.__hash(str(key).encode())
+
+        with self.__locked(start, self.probes, shared=True):
+            _, data, _ = self.__find(fingerprint, start, now)
+
+        return strategy.hit(strategy.create(policy) if data is None else strategy.decode(data), policy, now)
+
+    def reset(self, key):
+        fingerprint, start = self.__hash(str(key).encode())
+
+        with self.__locked(start, self.probes):
+            for index in range(start, start + self.probes):
+                if self.header.unpack_from(self.buffer, self.__offset(index))[0] == fingerprint:
+                    self.header.pack_into(self.buffer, self.__offset(index), 0, 0, 0, 0, b'')
+
+    def reset_matching(self, pattern):
+        reset = 0
+
+        for index in range(self.slots):
+            with self.__locked(index, 1):
+                fingerprint, _, key, _, _, _ = self.__slot(index)
+
+                if fingerprint and fnmatchcase(key.decode(errors='replace'), pattern):
+                    self.header.pack_into(self.buffer, self.__offset(index), 0, 0, 0, 0, b'')
+                    reset += 1
+
+        return reset
+
+    def export_states(self, strategies, now):
+        """
+        Keys longer than ``key_size`` bytes are only kept by their prefix, so they can't be exported and are skipped.
+
+        Args:
+            strategies (dict): Rate limiting algorithms by their name, the keys of the other strategies are skipped.
+            now (int): Current time in nanoseconds.
+
+        Yields:
+            tuple: Key, the strategy it's limited by, its state and the time in nanoseconds it expires, the expired
+                keys are skipped.
+
+        """
+        names = {self.__name(strategy): strategy for strategy in strategies.values()}
+
+        for index in range(self.slots):
+            with self.__locked(index, 1, shared=True):
+                fingerprint, deadline, key, truncated, name, data = self.__slot(index)
+
+            strategy = names.get(name)
+
+            if fingerprint and deadline > now and not truncated and strategy is not None:
+                yield key.decode(), strategy, strategy.decode(data), deadline
+
+    def import_states(self, states, now):
+        for key, strategy, state, deadline in states:
+            key = str(key).encode()
+            fingerprint, start = self.__hash(key)
+
+            with self.__locked(start, self.probes):
+                offset, _, _ = self.__find(fingerprint, start, now)
+                self.__write(offset, fingerprint, deadline, key, strategy, strategy.encode(state))
+
+    def __slot(self, index):
+        """
+        Args:
+            index (int): Index of the slot.
+
+        Returns:
+            tuple: Fingerprint of the key of the slot, 0 if it's empty, the time it expires, the encoded key, whether
+                it's cut at ``key_size`` bytes, the name of its strategy as written by ``__name``, and the packed
+                state.
+
+        """
+        offset = self.__offset(index)
+        fingerprint, deadline, key_length, length, name = self.header.unpack_from(self.buffer, offset)
+        position = offset + self.header.size
+        key = bytes(self.buffer[position:position + min(key_length, self.key_size)])
+        position += self.key_size
+        data = bytes(self.buffer[position:position + length])
+
+        return fingerprint, deadline, key, key_length > self.key_size, name.rstrip(b'\0'), data
+
+    @staticmethod
+    def __name(strategy):
+        """
+        Args:
+            strategy (Strategy): Rate limiting algorithm.
+
+        Returns:
+            bytes: Name of the strategy as kept in a slot, cut at 16 bytes.
+
+        """
+        return strategy.name.encode()[:16]
+
+    def __offset(self, index):
+        """
+        Args:
+            index (int): Index of the slot.
+
+        Returns:
+            int: Offset of the slot in the buffer.
+
+        """
+        return self.origin + index * self.stride
+
+    def __hash(self, key):
+        """
+        Args:
+            key (bytes): Encoded key which specifies the limitation.
+
+        Returns:
+            tuple: Fingerprint of the key, never 0 which marks an empty slot, and the first slot of its window.
+
+        """
+        fingerprint = int.from_bytes(blake2b(key, digest_size=8).digest(), 'little') or 1
+
+        return fingerprint, fingerprint % (self.slots - self.probes + 1)
+
+    @contextmanager
+    def __locked(self, start, length, shared=False):
+        """
+        Args:
+            start (int): First slot of the locked range.
+            length (int): Number of slots of the locked range.
+            shared (bool): Whether the range is only read.
+
+        """
+        with self.__lock:
+            fcntl.lockf(self.__descriptor, fcntl.LOCK_SH if shared else fcntl.LOCK_EX, length, start + 1)
+
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.__descriptor, fcntl.LOCK_UN, length, start + 1)
+
+    def __find(self, fingerprint, start, now):
+        """
+        Args:
+            fingerprint (int): Fingerprint of the key.
+            start (int): First slot of the window of the key.
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            tuple: Offset of the slot of the key, its packed state and the time it expires, None and 0 if the key
+                takes a new slot.
+
+        """
+        deadlines = dict()
+
+        for index in range(start, start + self.probes):
+            offset = self.__offset(index)
+            slot_fingerprint, deadline, _, length, _ = self.header.unpack_from(self.buffer, offset)
+
+            if slot_fingerprint == fingerprint:
+                position = offset + self.header.size + self.key_size
+                return offset, bytes(self.buffer[position:position + length]), deadline
+
+            deadlines[offset] = deadline if slot_fingerprint else 0
+
+        for offset, deadline in deadlines.items():
+            if deadline <= now:
+                return offset, None, 0
+
+        return min(deadlines, key=deadlines.get), None, 0
+
+    def __write(self, offset, fingerprint, deadline, key, strategy, data):
+        """
+        Args:
+            offset (int): Offset of the slot.
+            fingerprint (int): Fingerprint of the key.
+            deadline (int): Time in nanoseconds when the state expires.
+            key (bytes): Encoded key which specifies the limitation.
+            strategy (Strategy): Rate limiting algorithm the key is limited by.
+            data (bytes): State packed by the strategy.
+
+        Raises:
+            ValueError (ValueError): When the state doesn't fit the slot.
+
+        """
+        if len(data) > self.slot_size:
+            raise ValueError('State of {} bytes does not fit the {} bytes slot'.format(len(data), self.slot_size))
+
+        key_length = min(len(key), 0xFFFF)
+        key = key[:self.key_size]
+        position = offset + self.header.size
+
+        self.buffer[position:position + len(key)] = key
+        self.buffer[position + self.key_size:position + self.key_size + len(data)] = data
+        self.header.pack_into(
+            self.buffer, offset, fingerprint, deadline, key_length, len(data), self.__name(strategy)
+        )
+
+
+class SharedMemoryStorage(SlotTableStorage):
+    """
+    Slot table in a named shared memory segment, which every process attaches to by its name. The slots are locked on
+    a lock file next to the segment, and the segment outlives the processes until ``unlink`` is called.
+
+    """
+
+    def __init__(self, name='function-limiter', slots=4096, slot_size=1024, key_size=64, probes=8):
+        """
+        Args:
+            name (str): Name of the shared memory segment, the processes which use the same name share the state.
+            slots (int): Number of slots of the table, the most keys it keeps.
+            slot_size (int): Most bytes of the packed state of a key.
+            key_size (int): Most bytes of a key kept for ``reset_matching``, longer keys are matched by their prefix.
+            probes (int): Number of slots a key may take.
+
+        Raises:
+            ValueError (ValueError): When the existing segment is smaller than the table.
+
+        """
+        self.memory = _shared_memory(name, slots * self.slot_stride(slot_size, key_size))
+        self.path = os.path.join(tempfile.gettempdir(), '{}.lock'.format(name))
+        descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+
+        super().__init__(self.memory.buf, 0, descriptor, slots, slot_size, key_size, probes)
+
+        self.descriptor = descriptor
+
+    def close(self):
+        """
+        Detaches from the shared memory segment, the state is kept for the other processes.
+
+        """
+        self.buffer = None
+        self.memory.close()
+        os.close(self.descriptor)
+
+    def unlink(self):
+        """
+        Destroys the shared memory segment and its lock file, once every process is detached.
+
+        """
+        # Unlinking unregisters the segment from the resource tracker, which ``_shared_memory`` already did.
+        resource_tracker.register(self.memory._name, 'shared_memory')
+        self.memory.unlink()
+
+        with suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+
+class MappedFileStorage(SlotTableStorage):
+    """
+    Slot table in a memory mapped state file, so a restarted process maps it and resumes enforcing the limitations
+    without parsing anything. Writes land in the page cache, ``flush`` writes them to the disk.
+
+    The file starts with a header of its layout, and its slots are locked on the file itself. It uses the wall clock
+    so the states stay valid after a restart.
+
+    """
+    clock = staticmethod(time.time_ns)
+    layout = struct.Struct('<8sIIII')
+    magic = b'FNLIMIT2'
+    header_size = 64
+
+    def __init__(self, path, slots=4096, slot_size=1024, key_size=64, probes=8):
+        """
+        Args:
+            path (str): Path of the state file, the processes which use the same path share the state.
+            slots (int): Number of slots of the table, the most keys it keeps.
+            slot_size (int): Most bytes of the packed state of a key.
+            key_size (int): Most bytes of a key kept for ``reset_matching``, longer keys are matched by their prefix.
+            probes (int): Number of slots a key may take.
+
+        Raises:
+            ValueError (ValueError): When the existing state file has another layout.
+
+        """
+        size = self.header_size + slots * self.slot_stride(slot_size, key_size)
+        layout = self.layout.pack(self.magic, slots, slot_size, key_size, min(probes, slots))
+        descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+
+        try:
+            fcntl.lockf(descriptor, fcntl.LOCK_EX, 1, 0)
+
+            if not os.fstat(descriptor).st_size:
+                os.ftruncate(descriptor, size)
+                os.pwrite(descriptor, layout, 0)
+
+            elif os.pread(descriptor, self.layout.size, 0) != layout:
+                raise ValueError('State file {} has another layout'.format(path))
+
+            fcntl.lockf(descriptor, fcntl.LOCK_UN, 1, 0)
+        except BaseException:
+            os.close(descriptor)
+            raise
+
+        self.path = path
+        self.descriptor = descriptor
+        self.map = mmap.mmap(descriptor, size)
+
+        super().__init__(memoryview(self.map), self.header_size, descriptor, slots, slot_size, key_size, probes)
+
+    def flush(self):
+        """
+        Writes the changed pages of the state file to the disk, they survive a crash of the process without it.
+
+        """
+        self.map.flush()
+
+    def close(self):
+        """
+        Unmaps the state file, the state is kept in the file.
+
+        """
+        self.buffer.release()
+        self.buffer = None
+        self.map.close()
+        os.close(self.descriptor)
+
+
+async def _iterate(iterable):
+    """
+    Args:
+        iterable (typing.Iterable|typing.AsyncIterable): Items.
+
+    Yields:
+        object: Items of a synchronous or an asynchronous iterable.
+
+    """
+    if hasattr(iterable, '__aiter__'):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
+
+def _shared_memory(name, size):
+    """
+    Args:
+        name (str): Name of the shared memory segment.
+        size (int): Bytes the segment needs, a new segment is zero filled which marks its slots empty.
+
+    Raises:
+        ValueError (ValueError): When the existing segment is smaller than ``size``.
+
+    Returns:
+        multiprocessing.shared_memory.SharedMemory: Created or attached segment.
+
+    """
+    try:
+        memory = SharedMemory(name, create=True, size=size)
+    except FileExistsError:
+        memory = SharedMemory(name)
+
+    # The resource tracker would destroy the segment once the process which made it exits, while the other
+    # processes still use it.
+    with suppress(Exception):
+        resource_tracker.unregister(memory._name, 'shared_memory')
+
+    if memory.size < size:
+        memory.close()
+        raise ValueError('Shared memory {} is {} bytes, {} bytes are needed'.format(name, memory.size, size))
+
+    return memory
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage which keeps the state of each key in a row of an SQLite database in WAL mode, so the limitations survive
+    restarts and the processes of one host share them.
+
+    A decision reads and writes the row of its key in one ``BEGIN IMMEDIATE`` transaction, which the other processes
+    wait for up to ``timeout`` seconds. The statements are prepared once per connection by the statement cache of
+    ``sqlite3``, and each thread has its own connection. Expired rows are pruned every ``prune_interval`` seconds by
+    the decision which happens to commit first. It uses the wall clock so the states stay valid after a restart.
+
+    The whole state of a key is read and written by each decision, so the counter strategies, ``fixed-window``,
+    ``sliding-window`` and ``gcra``, decide in constant time, around twenty thousand decisions per second for a
+    process on a local disk. A sliding log rewrites eight bytes per kept tick, a few thousand decisions per second
+    once a key keeps thousands of ticks, so large quotas should use a counter strategy.
+
+    """
+    clock = staticmethod(time.time_ns)
+
+    def __init__(self, path, timeout=5, prune_interval=60):
+        """
+        Args:
+            path (str): Path of the database file, the processes which use the same path share the state.
+            timeout (float): Seconds a decision waits for the transaction of another one.
+            prune_interval (float): Seconds between the prunes of the expired rows.
+
+        """
+        self.path = path
+        self.timeout = timeout
+        self.prune_interval = prune_interval
+        self.__local = threading.local()
+        self.__pruned = 0
+        self.__connection()
+
+    def acquire(self, key, policy, strategy, now):
+        with self.__transaction() as connection:
+            row = connection.execute('SELECT state, deadline FROM function_limiter WHERE key = ?', (key,)).fetchone()
+            state, deadline = (strategy.create(policy), 0) if row is None else (strategy.decode(row[0]), row[1])
+
+            if strategy.hit(state, policy, now):
+                decision = True, None
+                deadline = now + strategy.ttl(policy)
+            else:
+                decision = False, strategy.retry_after(state, policy, now)
+
+            connection.execute(
+                'INSERT OR REPLACE INTO function_limiter (key, strategy, state, deadline) VALUES (?, ?, ?, ?)',
+                (key, strategy.name, strategy.encode(state), deadline)
+            )
+
+            if now >= self.__pruned + self.prune_interval * 10 ** 9:
+                connection.execute('DELETE FROM function_limiter WHERE deadline <= ?', (now,))
+                self.__pruned = now
+
+        return decision
+
+    def peek(self, key, policy, strategy, now):
+        row = self.__connection().execute('SELECT state FROM function_limiter WHERE key = ?', (key,)).fetchone()
+
+        return strategy.hit(strategy.create(policy) if row is None else strategy.decode(row[0]), policy, now)
+
+    def reset(self, key):
+        self.__connection().execute('DELETE FROM function_limiter WHERE key = ?', (key,))
+
+    def reset_many(self, keys):
+        with self.__transaction() as connection:
+            connection.executemany('DELETE FROM function_limiter WHERE key = ?', ((key,) for key in keys))
+
+    def reset_matching(self, pattern):
+        return self.__connection().execute('DELETE FROM function_limiter WHERE key GLOB ?', (pattern,)).rowcount
+
+    def export_states(self, strategies, now):
+        rows = self.__connection().execute(
+            'SELECT key, strategy, state, deadline FROM function_limiter WHERE deadline > ?', (now,)
+        )
+
+        for key, name, data, deadline in rows:
+            strategy = strategies.get(name)
+
+            if strategy is not None:
+                yield key, strategy, strategy.decode(data), deadline
+
+    def import_states(self, states, now):
+        states = iter(states)
+        batches = iter(
+            lambda: [
+                (str(key), strategy.name, strategy.encode(state), deadline)
+                for key, strategy, state, deadline in islice(states, 1000)
+            ],
+            []
+        )
+
+        for batch in batches:
+            with self.__transaction() as connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO function_limiter (key, strategy, state, deadline) VALUES (?, ?, ?, ?)',
+                    batch
+                )
+
+    def close(self):
+        """
+        Closes the connection of the current thread.
+
+        """
+        connection = getattr(self.__local, 'connection', None)
+
+        if connection is not None:
+            connection.close()
+            self.__local.connection = None
+
+    def __connection(self):
+        """
+        Returns:
+            sqlite3.Connection: Connection of the current thread, which is opened on its first use. A table created
+                before the name of the strategy was kept gets the column, its rows aren't exported.
+
+        """
+        connection = getattr(self.__local, 'connection', None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS function_limiter '
+                "(key TEXT PRIMARY KEY, strategy TEXT NOT NULL DEFAULT '', state BLOB NOT NULL, "
+                'deadline INTEGER NOT NULL) WITHOUT ROWID'
+            )
+
+            if 'strategy' not in {row[1] for row in connection.execute('PRAGMA table_info(function_limiter)')}:
+                # Another process may add the column first.
+                with suppress(sqlite3.OperationalError):
+                    connection.execute("ALTER TABLE function_limiter ADD COLUMN strategy TEXT NOT NULL DEFAULT ''")
+
+            self.__local.connection = connection
+
+        return connection
+
+    @contextmanager
+    def __transaction(self):
+        """
+        Yields:
+            sqlite3.Connection: Connection of the current thread in a write transaction, which is committed unless
+                it raises.
+
+        """
+        connection = self.__connection()
+        connection.execute('BEGIN IMMEDIATE')
+
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        connection.execute('COMMIT')
+
+
+class Lease(object):
+    """
+    Block of permits taken from Redis, which are spent locally until it expires.
+
+    """
+    __slots__ = ('policy', 'strategy', 'granted', 'remaining', 'acquired', 'expires')
+
+    def __init__(self, policy, strategy, granted, acquired, expires):
+        """
+        Args:
+            policy (Policy): Compiled limitations the permits are taken for.
+            strategy (Strategy): Rate limiting algorithm the permits are taken by.
+            granted (int): Permits taken from Redis.
+            acquired (int): Time in nanoseconds when the permits were taken.
+            expires (int): Time in nanoseconds when the unused permits are given back.
+
+        """
+        self.policy = policy
+        self.strategy = strategy
+        self.granted = granted
+        self.remaining = granted
+        self.acquired = acquired
+        self.expires = expires
+
+
+class RedisStorage(Storage):
+    """
+    Storage which keeps each key in its own Redis key, and decides and records a call in one round trip by the Lua
+    script of the strategy. The client is only used through its commands, so redis-py isn't imported here.
+
+    Bulk resets unlink at most ``batch`` keys per command and scan for patterns ``batch`` keys at a time, so Redis
+    frees the values in the background and serves other clients in between.
+
+    With ``invalidation`` the storages of one database share a pub/sub channel, resets are published on it and each
+    storage drops its local state of the published keys, so leases don't outlive a reset on another host.
+
+    The unused permits of a lease are given back once it expires, by the next lease of its key or by a daemon thread
+    which sweeps the expired leases every ``lease_ttl`` seconds while there are any.
+
+    """
+    clock = staticmethod(time.time_ns)
+    batch = 1000
+
+    def __init__(self, client, database_name='function-limiter', lease=None, lease_ttl=1, invalidation=False):
+        """
+        Args:
+            client (redis.Redis|redis.cluster.RedisCluster): Redis client.
+            database_name (str): Name of the database which keeps the logs.
+            lease (float|None): Most share of the smallest limitation count a lease takes, leases are disabled if it
+                isn't defined. Only strategies which define ``lease_script`` are leased.
+            lease_ttl (float): Seconds a lease is spent locally before its unused permits are given back.
+            invalidation (bool): Whether resets are published to, and the local state is invalidated by, the other
+                storages of the database.
+
+        """
+        self.client = client
+        self.database_name = database_name
+        self.lease = lease
+        self.lease_ttl = lease_ttl
+        self.invalidation = invalidation
+        self.channel = '{}:invalidations'.format(database_name)
+        self._scripts = dict()
+        self._leases = OrderedDict()
+        self._lock = threading.Lock()
+        self._origin = uuid4().hex
+        self._listener = None
+        self._sweeper = None
+        self._last = None
+
+        if invalidation:
+            self.listen()
+
+    def name(self, key):
+        """
+        Args:
+            key (str): Key which specifies the limitation.
+
+        Returns:
+            str: Name of the Redis key, the key is a hash tag so everything kept for it lands on one cluster slot.
+
+        """
+        return '{}:{{{}}}'.format(self.database_name, key)
+
+    def acquire(self, key, policy, strategy, now):
+        if self.lease and strategy.lease_script:
+            decision = self._leased(key, policy, now)
+
+            if decision is None:
+                arguments = self._lease_request(key, policy, strategy, now)
+                granted = self._script(strategy.lease_script)(keys=[self.name(key)], args=arguments)
+                decision = self._lease_grant(key, policy, strategy, now, granted)
+                self._sweep()
+
+            return decision
+
+        arguments = self._arguments(policy, strategy, now, True)
+
+        return self._verdict(*self._script(strategy.script)(keys=[self.name(key)], args=arguments))
+
+    def peek(self, key, policy, strategy, now):
+        if self.lease and strategy.lease_script and self._spendable(key, policy, now):
+            return True
+
+        arguments = self._arguments(policy, strategy, now, False)
+
+        return self._verdict(*self._script(strategy.script)(keys=[self.name(key)], args=arguments))[0]
+
+    def reset(self, key):
+        """
+        Args:
+            key (str): Key which specifies the limitation.
+
+        Returns:
+            typing.Awaitable|int: Deletion which should be awaited on an asyncio client.
+
+        """
+        return self.reset_many([key])
+
+    def reset_many(self, keys):
+        """
+        Args:
+            keys (typing.Iterable[str]): Keys which specify the limitations.
+
+        Returns:
+            typing.Awaitable|int: Deletion which should be awaited on an asyncio client.
+
+        """
+        keys = list(keys)
+        deleted = 0
+        self.invalidate(keys)
+
+        for i in range(0, len(keys), self.batch):
+            deleted += self.client.unlink(*map(self.name, keys[i:i + self.batch]))
+
+        if keys and self.invalidation:
+            self.publish(keys)
+
+        return deleted
+
+    def reset_matching(self, pattern):
+        """
+        Args:
+            pattern (str): Glob style pattern of the keys, like ``'tenant-*'``.
+
+        Returns:
+            typing.Awaitable|int: Number of keys which are reset, which should be awaited on an asyncio client.
+
+        """
+        keys = list()
+        deleted = 0
+        self.invalidate(self._leased_matching(pattern))
+
+        for name in self.client.scan_iter(match=self.name(pattern), count=self.batch):
+            keys.append(self.key(name))
+
+            if len(keys) == self.batch:
+                deleted += self.reset_many(keys)
+                keys = list()
+
+        return deleted + self.reset_many(keys)
+
+    def export_states(self, strategies, now):
+        """
+        Reads the keys ``batch`` at a time in one pipeline. A hash is limited by the strategy named by its ``strategy``
+        field, and a sorted set by the strategy which keeps sorted sets, the other keys are skipped.
+
+        Args:
+            strategies (dict): Rate limiting algorithms by their name, the keys of the other strategies are skipped.
+            now (int): Current time in nanoseconds.
+
+        Yields:
+            tuple: Key, the strategy it's limited by, its state and the time in nanoseconds it expires, the expired
+                keys are skipped.
+
+        """
+        names = list()
+
+        for name in self.client.scan_iter(match=self.name('*'), count=self.batch):
+            names.append(name)
+
+            if len(names) == self.batch:
+                replies = self._export(names).execute(raise_on_error=False)
+                yield from self._exported(names, replies, strategies, now)
+                names = list()
+
+        replies = self._export(names).execute(raise_on_error=False)
+        yield from self._exported(names, replies, strategies, now)
+
+    def import_states(self, states, now):
+        """
+        Writes the keys ``batch`` at a time in one pipeline, their leases are dropped.
+
+        Args:
+            states (typing.Iterable[tuple]): Keys, the strategies they're limited by, their states and the times in
+                nanoseconds they expire.
+            now (int): Current time in nanoseconds.
+
+        """
+        states = iter(states)
+
+        for batch in iter(lambda: list(islice(states, self.batch)), []):
+            self._import(batch, now).execute()
+
+    def _export(self, names):
+        """
+        Args:
+            names (list): Names of the Redis keys.
+
+        Returns:
+            redis.client.Pipeline: Pipeline which reads the fields of each key, its members and scores, and its time
+                to live, reading a key as the other type fails.
+
+        """
+        pipeline = self.client.pipeline(transaction=False)
+
+        for name in names:
+            pipeline.hgetall(name)
+            pipeline.zrange(name, 0, -1, withscores=True)
+            pipeline.pttl(name)
+
+        return pipeline
+
+    def _exported(self, names, replies, strategies, now):
+        """
+        Args:
+            names (list): Names of the Redis keys.
+            replies (list): Replies of the pipeline of ``_export``.
+            strategies (dict): Rate limiting algorithms by their name, the keys of the other strategies are skipped.
+            now (int): Current time in nanoseconds.
+
+        Yields:
+            tuple: Key, the strategy it's limited by, its state and the time in nanoseconds it expires.
+
+        """
+        ordered = next((strategy for strategy in strategies.values() if strategy.redis_type == 'zset'), None)
+
+        for name, fields, members, ttl in zip(names, replies[::3], replies[1::3], replies[2::3]):
+            if isinstance(ttl, Exception) or ttl <= 0:
+                continue
+
+            if fields and not isinstance(fields, Exception):
+                fields = dict(fields)
+                strategy = fields.get(b'strategy', fields.get('strategy'))
+                strategy = strategies.get(strategy.decode() if isinstance(strategy, bytes) else strategy)
+                data = fields
+            elif members and not isinstance(members, Exception):
+                strategy = ordered
+                data = dict(members)
+            else:
+                continue
+
+            if strategy is not None:
+                yield self.key(name), strategy, strategy.from_redis(data), now + ttl * 10 ** 6
+
+    def _import(self, batch, now):
+        """
+        Args:
+            batch (list): Keys, the strategies they're limited by, their states and the times in nanoseconds they
+                expire.
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            redis.client.Pipeline: Pipeline which replaces the keys.
+
+        """
+        pipeline = self.client.pipeline(transaction=False)
+        self.invalidate(key for key, _, _, _ in batch)
+
+        for key, strategy, state, deadline in batch:
+            name = self.name(key)
+            data = strategy.to_redis(state)
+            pipeline.delete(name)
+
+            if data and strategy.redis_type == 'zset':
+                pipeline.zadd(name, data)
+            elif strategy.redis_type != 'zset':
+                pipeline.hset(name, mapping=dict(data, strategy=strategy.name))
+
+            pipeline.pexpire(name, max(-(-(deadline - now) // 10 ** 6), 1))
+
+        return pipeline
+
+    def key(self, name):
+        """
+        Args:
+            name (bytes|str): Name of the Redis key.
+
+        Returns:
+            str: Key which specifies the limitation.
+
+        """
+        if isinstance(name, bytes):
+            name = name.decode()
+
+        return name[len(self.database_name) + 2:-1]
+
+    def invalidate(self, keys):
+        """
+        Drops the local state of the keys, the leases which are spent without asking Redis. The leases are guarded by
+        a lock, since the invalidations are received in another thread.
+
+        Args:
+            keys (typing.Iterable[str]): Keys which specify the limitations.
+
+        """
+        with self._lock:
+            for key in keys:
+                self._leases.pop(key, None)
+
+    def _leased_matching(self, pattern):
+        """
+        Args:
+            pattern (str): Glob style pattern of the keys.
+
+        Returns:
+            list: Keys which match the pattern and have a lease.
+
+        """
+        with self._lock:
+            return [key for key in self._leases if fnmatchcase(str(key), pattern)]
+
+    def publish(self, keys):
+        """
+        Invalidates the keys on the other storages of the database, like after their limitations are changed.
+
+        Args:
+            keys (typing.Iterable[str]): Keys which specify the limitations.
+
+        Returns:
+            typing.Awaitable|int: Publication which should be awaited on an asyncio client.
+
+        """
+        return self.client.publish(self.channel, json.dumps({'origin': self._origin, 'keys': list(keys)}))
+
+    def listen(self):
+        """
+        Subscribes to the invalidations of the database in a daemon thread.
+
+        """
+        if self._listener is None:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self._receive})
+            self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def close(self):
+        """
+        Stops listening to the invalidations of the database.
+
+        """
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def _receive(self, message):
+        """
+        Args:
+            message (dict): Message of the invalidations channel.
+
+        """
+        invalidation = json.loads(message['data'])
+
+        if invalidation['origin'] != self._origin:
+            self.invalidate(invalidation['keys'])
+
+    def ping(self):
+        """
+        Returns:
+            typing.Awaitable|bool: Whether Redis is reachable, which should be awaited on an asyncio client.
+
+        """
+        return self.client.ping()
+
+    def release(self, now):
+        """
+        Gives back the unused permits of the leases which are expired, and drops them.
+
+        Args:
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            typing.Awaitable|int: Permits given back, which should be awaited on an asyncio client.
+
+        """
+        released = 0
+
+        for key, lease in self._expired(now):
+            self._script(lease.strategy.lease_script)(keys=[self.name(key)], args=self._give_back(lease, now))
+            released += lease.remaining
+
+        return released
+
+    def _expired(self, now):
+        """
+        Args:
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            list: Keys and leases which are expired and still have unused permits, all the expired leases are dropped.
+
+        """
+        with self._lock:
+            expired = [(key, lease) for key, lease in self._leases.items() if lease.expires <= now]
+
+            for key, _ in expired:
+                del self._leases[key]
+
+        return [(key, lease) for key, lease in expired if lease.remaining > 0]
+
+    @staticmethod
+    def _give_back(lease, now):
+        """
+        Args:
+            lease (Lease): Expired lease.
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            list: Arguments of the lease script which gives back the unused permits of the lease and takes none.
+
+        """
+        return [-(-lease.strategy.ttl(lease.policy) // 10 ** 6)] + lease.strategy.lease_arguments(
+            lease.policy, now, 0, lease
+        )
+
+    def _now(self):
+        """
+        Returns:
+            int: Time in nanoseconds of the last lease, on the clock the storage is called with, advanced by the time
+                since.
+
+        """
+        now, started = self._last
+
+        return now + time.monotonic_ns() - started
+
+    def _sweep(self):
+        """
+        Starts the daemon thread which gives back the expired leases, unless it's already running.
+
+        """
+        if self._sweeper is None or not self._sweeper.is_alive():
+            self._sweeper = threading.Thread(target=self.__sweep, daemon=True)
+            self._sweeper.start()
+
+    def __sweep(self):
+        while self._leases:
+            time.sleep(self.lease_ttl)
+
+            with suppress(Exception):
+                self.release(self._now())
+
+    def _script(self, source):
+        """
+        Args:
+            source (str): Lua source of the script.
+
+        Returns:
+            redis.commands.core.Script: Script which is loaded once and run by its SHA afterwards.
+
+        """
+        script = self._scripts.get(source)
+
+        if script is None:
+            script = self._scripts[source] = self.client.register_script(source)
+
+        return script
+
+    @staticmethod
+    def _arguments(policy, strategy, now, record):
+        """
+        Args:
+            policy (Policy): Compiled limitations wanted to apply.
+            strategy (Strategy): Rate limiting algorithm.
+            now (int): Current time in nanoseconds.
+            record (bool): Whether the script records the call if it's permitted.
+
+        Returns:
+            list: Arguments of the script of the strategy.
+
+        """
+        return [-(-strategy.ttl(policy) // 10 ** 6), int(record)] + strategy.arguments(policy, now)
+
+    @staticmethod
+    def _verdict(permitted, retry_after):
+        """
+        Args:
+            permitted (int): Whether the Redis script permitted the call.
+            retry_after (int): Microseconds until the next call is permitted, -1 if the strategy can't tell.
+
+        Returns:
+            tuple: Whether the call is permitted, and the nanoseconds until the next call is permitted.
+
+        """
+        return bool(permitted), None if retry_after < 0 else retry_after * 1000
+
+    def _spendable(self, key, policy, now):
+        """
+        Args:
+            key (str): Key which specifies the limitation.
+            policy (Policy): Compiled limitations wanted to apply.
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            bool: Whether the lease of the key has a permit left.
+
+        """
+        lease = self._leases.get(key)
+
+        return lease is not None and now < lease.expires and lease.policy == policy and lease.remaining > 0
+
+    def _leased(self, key, policy, now):
+        """
+        Args:
+            key (str): Key which specifies the limitation.
+            policy (Policy): Compiled limitations wanted to apply.
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            tuple|None: Decision of the call if a permit of the lease is spent or its last lease didn't get any permit
+                and isn't expired yet, None if a new lease is needed.
+
+        """
+        lease = self._leases.get(key)
+
+        if lease is None or now >= lease.expires or lease.policy != policy:
+            return None
+
+        if lease.remaining:
+            lease.remaining -= 1
+            return True, None
+
+        if not lease.granted:
+            return False, lease.expires - now
+
+        return None
+
+    def _lease_request(self, key, policy, strategy, now):
+        """
+        Sizes the next lease of the key by the rate its previous lease was spent, up to ``lease`` share of the smallest
+        limitation count. The previous lease is dropped, its unused permits are given back by the lease script.
+
+        Args:
+            key (str): Key which specifies the limitation.
+            policy (Policy): Compiled limitations wanted to apply.
+            strategy (Strategy): Rate limiting algorithm.
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            list: Arguments of the lease script.
+
+        """
+        with self._lock:
+            lease = self._leases.pop(key, None)
+
+        ceiling = max(int(self.lease * min((limit_count for limit_count, _ in policy), default=1)), 1)
+
+        if lease is not None and lease.policy != policy:
+            lease = None
+
+        if lease is None or now <= lease.acquired:
+            size = 1
+        else:
+            rate = (lease.granted - lease.remaining) / (now - lease.acquired)
+            size = min(max(ceil(rate * self.lease_ttl * 10 ** 9), 1), ceiling)
+
+        return [-(-strategy.ttl(policy) // 10 ** 6)] + strategy.lease_arguments(policy, now, size, lease)
+
+    def _lease_grant(self, key, policy, strategy, now, granted):
+        """
+        Args:
+            key (str): Key which specifies the limitation.
+            policy (Policy): Compiled limitations wanted to apply.
+            strategy (Strategy): Rate limiting algorithm.
+            now (int): Current time in nanoseconds.
+            granted (int): Permits the lease script took.
+
+        Returns:
+            tuple: Decision of the call, which spends a permit of the new lease if it got any.
+
+        """
+        expires = now + round(self.lease_ttl * 10 ** 9)
+        expiry = strategy.lease_expiry(policy, now)
+        lease = Lease(policy, strategy, granted, now, expires if expiry is None else min(expires, expiry))
+
+        with self._lock:
+            self._leases.pop(key, None)
+            self._leases[key] = lease
+            self._last = now, time.monotonic_ns()
+
+        if not granted:
+            return False, lease.expires - now
+
+        lease.remaining -= 1
+
+        return True, None
+
+
+class AsyncRedisStorage(RedisStorage):
+    """
+    Same as ``RedisStorage`` on an asyncio Redis client, so the event loop isn't blocked by the round trip. The
+    invalidations are listened to by a task, which starts with the first call on the event loop, and the expired
+    leases are swept by another task.
+
+    """
+    asynchronous = True
+
+    async def acquire(self, key, policy, strategy, now):
+        if self.invalidation:
+            self.listen()
+
+        if self.lease and strategy.lease_script:
+            decision = self._leased(key, policy, now)
+
+            if decision is None:
+                arguments = self._lease_request(key, policy, strategy, now)
+                granted = await self._script(strategy.lease_script)(keys=[self.name(key)], args=arguments)
+                decision = self._lease_grant(key, policy, strategy, now, granted)
+                self._sweep()
+
+            return decision
+
+        arguments = self._arguments(policy, strategy, now, True)
+
+        return self._verdict(*await self._script(strategy.script)(keys=[self.name(key)], args=arguments))
+
+    async def peek(self, key, policy, strategy, now):
+        if self.lease and strategy.lease_script and self._spendable(key, policy, now):
+            return True
+
+        arguments = self._arguments(policy, strategy, now, False)
+
+        return self._verdict(*await self._script(strategy.script)(keys=[self.name(key)], args=arguments))[0]
+
+    async def reset_many(self, keys):
+        keys = list(keys)
+        deleted = 0
+        self.invalidate(keys)
+
+        for i in range(0, len(keys), self.batch):
+            deleted += await self.client.unlink(*map(self.name, keys[i:i + self.batch]))
+
+        if keys and self.invalidation:
+            await self.publish(keys)
+
+        return deleted
+
+    async def reset_matching(self, pattern):
+        keys = list()
+        deleted = 0
+        self.invalidate(self._leased_matching(pattern))
+
+        async for name in self.client.scan_iter(match=self.name(pattern), count=self.batch):
+            keys.append(self.key(name))
+
+            if len(keys) == self.batch:
+                deleted += await self.reset_many(keys)
+                keys = list()
+
+        return deleted + await self.reset_many(keys)
+
+    async def export_states(self, strategies, now):
+        names = list()
+
+        async for name in self.client.scan_iter(match=self.name('*'), count=self.batch):
+            names.append(name)
+
+            if len(names) == self.batch:
+                replies = await self._export(names).execute(raise_on_error=False)
+
+                for state in self._exported(names, replies, strategies, now):
+                    yield state
+
+                names = list()
+
+        replies = await self._export(names).execute(raise_on_error=False)
+
+        for state in self._exported(names, replies, strategies, now):
+            yield state
+
+    async def import_states(self, states, now):
+        batch = list()
+
+        async for state in _iterate(states):
+            batch.append(state)
+
+            if len(batch) == self.batch:
+                await self._import(batch, now).execute()
+                batch = list()
+
+        if batch:
+            await self._import(batch, now).execute()
+
+    async def release(self, now):
+        released = 0
+
+        for key, lease in self._expired(now):
+            await self._script(lease.strategy.lease_script)(keys=[self.name(key)], args=self._give_back(lease, now))
+            released += lease.remaining
+
+        return released
+
+    def _sweep(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.get_running_loop().create_task(self.__sweep())
+
+    async def __sweep(self):
+        while self._leases:
+            await asyncio.sleep(self.lease_ttl)
+
+            with suppress(Exception):
+                await self.release(self._now())
+
+    def listen(self):
+        """
+        Subscribes to the invalidations of the database in a task of the running event loop, nothing is done outside
+        of an event loop.
+
+        """
+        if self._listener is None or self._listener.done():
+            with suppress(RuntimeError):
+                self._listener = asyncio.get_running_loop().create_task(self.__listen())
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+
+    async def __listen(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+
+        try:
+            await pubsub.subscribe(self.channel)
+
+            async for message in pubsub.listen():
+                self._receive(message)
+        finally:
+            await pubsub.aclose()
+
+
+class FallbackStorage(Storage):
+    """
+    Circuit breaker which decides on ``storage`` while it's healthy. Once a decision raises or takes longer than
+    ``budget`` the circuit opens, and calls are decided on a local storage with ``share`` of each limitation count
+    until a background probe of ``storage`` answers within the budget again.
+
+    A synchronous decision can't be cut short, the client's socket timeout bounds it, so the circuit only opens after
+    the first slow decision.
+
+    While the circuit is open each instance permits ``share`` of the limitations on its own, so N instances permit up to
+    ``N * share`` times the limitations, on top of what was permitted on ``storage`` in the same windows. There's no
+    safe default, one over the number of instances keeps the limitations.
+
+    Resets always reach the local storage, and ``storage`` while the circuit is closed. A reset of ``storage`` which
+    raises opens the circuit instead of raising.
+
+    """
+
+    def __init__(self, storage, share, budget=0.05, interval=1, fallback=None):
+        """
+        Args:
+            storage (Storage): Shared storage, usually a ``RedisStorage``.
+            share (float): Share of each limitation count the local storage permits, one over the number of instances
+                which share ``storage``.
+            budget (float): Most seconds a decision of ``storage`` may take before the circuit opens.
+            interval (float): Seconds between the probes of ``storage`` while the circuit is open.
+            fallback (Storage|None): Local storage, a ``MemoryStorage`` if it isn't defined.
+
+        Raises:
+            ValueError (ValueError): When share isn't more than 0 and at most 1.
+
+        """
+        if not 0 < share <= 1:
+            raise ValueError('Share should be more than 0 and at most 1, got {}'.format(share))
+
+        self.storage = storage
+        self.fallback = MemoryStorage() if fallback is None else fallback
+        self.share = share
+        self.budget = budget
+        self.interval = interval
+        self.clock = storage.clock
+        self.tripped = False
+        self._policies = dict()
+        self._probe = None
+
+    def acquire(self, key, policy, strategy, now):
+        if not self.tripped:
+            started = time.monotonic()
+
+            try:
+                decision = self.storage.acquire(key, policy, strategy, now)
+            except Exception:
+                self._trip()
+            else:
+                if time.monotonic() - started > self.budget:
+                    self._trip()
+
+                return decision
+
+        return self.fallback.acquire(key, self._scale(policy), strategy, now)
+
+    def peek(self, key, policy, strategy, now):
+        if not self.tripped:
+            with suppress(Exception):
+                return self.storage.peek(key, policy, strategy, now)
+
+        return self.fallback.peek(key, self._scale(policy), strategy, now)
+
+    def reset(self, key):
+        self.fallback.reset(key)
+
+        return self._shared(self.storage.reset, key)
+
+    def reset_many(self, keys):
+        keys = list(keys)
+        self.fallback.reset_many(keys)
+
+        return self._shared(self.storage.reset_many, keys)
+
+    def reset_matching(self, pattern):
+        reset = self.fallback.reset_matching(pattern)
+
+        return self._shared(self.storage.reset_matching, pattern, default=reset)
+
+    def export_states(self, strategies, now):
+        return self.storage.export_states(strategies, now)
+
+    def import_states(self, states, now):
+        return self.storage.import_states(states, now)
+
+    def ping(self):
+        return self.storage.ping()
+
+    def _shared(self, method, *args, default=None):
+        """
+        Resets ``storage`` while the circuit is closed, a reset which raises opens the circuit instead of reaching the
+        caller. Resets are skipped while the circuit is open, so the keys stay limited on ``storage``.
+
+        Args:
+            method (function): Reset method of ``storage``.
+            *args: Arguments of the method.
+            default (object): Result when ``storage`` isn't reset.
+
+        Returns:
+            object: Result of the method, the default if it isn't reset.
+
+        """
+        if not self.tripped:
+            try:
+                return method(*args)
+            except Exception:
+                self._trip()
+
+        return default
+
+    def _scale(self, policy):
+        """
+        Args:
+            policy (Policy): Compiled limitations wanted to apply.
+
+        Returns:
+            Policy: Compiled limitations with ``share`` of each limitation count.
+
+        """
+        scaled = self._policies.get(policy)
+
+        if scaled is None:
+            scaled = self._policies[policy] = type(policy)(
+                (limit_count * self.share, period) for limit_count, period in policy
+            )
+
+        return scaled
+
+    def _trip(self):
+        """
+        Opens the circuit and starts probing ``storage`` in a daemon thread, unless it's already probed.
+
+        """
+        self.tripped = True
+
+        if self._probe is None or not self._probe.is_alive():
+            self._probe = threading.Thread(target=self.__probe, daemon=True)
+            self._probe.start()
+
+    def __probe(self):
+        while self.tripped:
+            time.sleep(self.interval)
+            started = time.monotonic()
+
+            with suppress(Exception):
+                self.storage.ping()
+                self.tripped = time.monotonic() - started > self.budget
+
+
+class AsyncFallbackStorage(FallbackStorage):
+    """
+    Same as ``FallbackStorage`` on an asynchronous storage, where a decision is cancelled once it takes longer than
+    ``budget`` and the probe is a task of the event loop.
+
+    """
+    asynchronous = True
+
+    async def acquire(self, key, policy, strategy, now):
+        if not self.tripped:
+            try:
+                return await asyncio.wait_for(self.storage.acquire(key, policy, strategy, now), self.budget)
+            except Exception:
+                self._trip()
+
+        return self.fallback.acquire(key, self._scale(policy), strategy, now)
+
+    async def peek(self, key, policy, strategy, now):
+        if not self.tripped:
+            with suppress(Exception):
+                return await asyncio.wait_for(self.storage.peek(key, policy, strategy, now), self.budget)
+
+        return self.fallback.peek(key, self._scale(policy), strategy, now)
+
+    async def reset(self, key):
+        self.fallback.reset(key)
+
+        return await self._shared(self.storage.reset, key)
+
+    async def reset_many(self, keys):
+        keys = list(keys)
+        self.fallback.reset_many(keys)
+
+        return await self._shared(self.storage.reset_many, keys)
+
+    async def reset_matching(self, pattern):
+        reset = self.fallback.reset_matching(pattern)
+
+        return await self._shared(self.storage.reset_matching, pattern, default=reset)
+
+    async def _shared(self, method, *args, default=None):
+        if not self.tripped:
+            try:
+                return await method(*args)
+            except Exception:
+                self._trip()
+
+        return default
+
+    def _trip(self):
+        self.tripped = True
+
+        if self._probe is None or self._probe.done():
+            self._probe = asyncio.get_running_loop().create_task(self.__probe())
+
+    async def __probe(self):
+        while self.tripped:
+            await asyncio.sleep(self.interval)
+
+            with suppress(Exception):
+                await asyncio.wait_for(self.storage.ping(), self.budget)
+                self.tripped = False
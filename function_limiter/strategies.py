@@ -0,0 +1,845 @@
+"""Rate limiting algorithms used by the limiter."""
+import sys
+from array import array
+from math import ceil
+from random import getrandbits
+from struct import pack
+
+_missing = -2 ** 63
+
+
+class Strategy(object):
+    """
+    Base class of rate limiting algorithms.
+
+    A strategy owns the shape of the state stored per key. ``hit`` decides on a call and records it when it is
+    permitted, ``load`` and ``dump`` convert the state to and from a JSON friendly form, and ``encode`` and ``decode``
+    to and from packed little-endian int64s wherever it's persisted.
+
+    ``script`` is the same decision as a Redis Lua script which gets the key name as ``KEYS[1]`` and ``arguments`` as
+    ``ARGV``, and returns whether it permitted and the microseconds until the next call is permitted, -1 if it can't
+    tell. Redis keeps times in microseconds so they fit in Lua numbers exactly. The storage passes two arguments
+    before ``arguments``, the ``ttl`` in milliseconds which the script sets on the key whenever it writes, so idle
+    keys expire by themselves, and ``1`` to record the call or ``0`` to only peek.
+
+    Strategies which count permits can define ``lease_script``, which gives back the unused permits of the previous
+    lease and takes a block of permits atomically, returning how many it took. It gets the ``ttl`` before
+    ``lease_arguments``. ``redis_type`` is the type of the Redis key the script keeps, which ``from_redis`` and
+    ``to_redis`` convert the state from and to. Scripts which keep a hash write the strategy ``name`` in its
+    ``strategy`` field, so the state of a key can be told apart from the states of other strategies.
+
+    """
+    name = None
+    script = None
+    lease_script = None
+    redis_type = 'hash'
+
+    def create(self, policy):
+        """
+        Args:
+            policy (Policy): Compiled limitations wanted to apply.
+
+        Returns:
+            object: Empty state for a new key.
+
+        """
+        raise NotImplementedError
+
+    def hit(self, state, policy, now):
+        """
+        Args:
+            state (object): State of the key, updated in place.
+            policy (Policy): Compiled limitations wanted to apply.
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            bool: True if it permitted, False if otherwise
+
+        """
+        raise NotImplementedError
+
+    def arguments(self, policy, now):
+        """
+        Args:
+            policy (Policy): Compiled limitations wanted to apply.
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            list: Arguments of the Redis script.
+
+        """
+        raise NotImplementedError
+
+    def lease_arguments(self, policy, now, size, lease):
+        """
+        Args:
+            policy (Policy): Compiled limitations wanted to apply.
+            now (int): Current time in nanoseconds.
+            size (int): Permits wanted to take.
+            lease (Lease|None): Previous lease of the key, its unused permits are given back.
+
+        Returns:
+            list: Arguments of the lease script.
+
+        """
+        raise NotImplementedError
+
+    def lease_expiry(self, policy, now):
+        """
+        Args:
+            policy (Policy): Compiled limitations wanted to apply.
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            int|None: Time in nanoseconds when permits taken now stop being valid, None if they don't.
+
+        """
+        raise NotImplementedError
+
+    def ttl(self, policy):
+        """
+        Args:
+            policy (Policy): Compiled limitations wanted to apply.
+
+        Returns:
+            int: Nanoseconds after the last permitted call when the state of the key is fully expired.
+
+        """
+        return max((period for _, period in policy.windows), default=0)
+
+    def retry_after(self, state, policy, now):
+        """
+        Args:
+            state (object): State of the key.
+            policy (Policy): Compiled limitations wanted to apply.
+            now (int): Current time in nanoseconds.
+
+        Returns:
+            int|None: Nanoseconds until the next call is permitted, None if the strategy can't tell.
+
+        """
+        return None
+
+    def load(self, state):
+        """
+        Args:
+            state (list): State in JSON friendly form.
+
+        Returns:
+            object: State of the key.
+
+        """
+        return state
+
+    def dump(self, state):
+        """
+        Args:
+            state (object): State of the key.
+
+        Returns:
+            list: State in JSON friendly form.
+
+        """
+        return state
+
+    def encode(self, state):
+        """
+        Args:
+            state (object): State of the key.
+
+        Returns:
+            bytes: Width of the rows of the JSON friendly form followed by their values, as little-endian int64s
+                where ``None`` is the smallest int64.
+
+        """
+        rows = self.dump(state)
+        values = array('q', [len(rows[0]) if rows else 0])
+        values.extend(_missing if value is None else value for row in rows for value in row)
+
+        return _little_endian(values).tobytes()
+
+    def decode(self, data):
+        """
+        Args:
+            data (bytes): State packed by ``encode``.
+
+        Returns:
+            object: State of the key.
+
+        """
+        values = array('q')
+        values.frombytes(data)
+        values = _little_endian(values)
+        width = values[0]
+        values = [None if value == _missing else value for value in values[1:]]
+
+        return self.load([values[i:i + width] for i in range(0, len(values), width)] if width else [])
+
+    def size(self, policy):
+        """
+        Args:
+            policy (Policy): Compiled limitations wanted to apply.
+
+        Returns:
+            int: Most bytes of a state of the policy packed by ``encode``.
+
+        """
+        return len(self.encode(self.create(policy)))
+
+    def rebase(self, state, source, target):
+        """
+        Args:
+            state (object): State of the key.
+            source (int): Time in nanoseconds on the clock the state is kept by.
+            target (int): Same moment as ``source`` in nanoseconds on the clock the state is moved to.
+
+        Returns:
+            object: State of the key on the target clock, a window keeps its distance from the current window.
+
+        """
+        raise NotImplementedError
+
+    def from_redis(self, data):
+        """
+        Args:
+            data (dict): Fields and values of the Redis key, members and scores if it's a sorted set.
+
+        Returns:
+            object: State of the key, windows are ordered by their period.
+
+        """
+        raise NotImplementedError
+
+    def to_redis(self, state):
+        """
+        Args:
+            state (object): State of the key.
+
+        Returns:
+            dict: Fields and values of the Redis key, members and scores if it's a sorted set.
+
+        """
+        raise NotImplementedError
+
+
+def _fields(data):
+    """
+    Args:
+        data (dict): Fields and values of a Redis hash.
+
+    Returns:
+        dict: Text fields and integer values, Lua may write big numbers in exponent form, without the strategy name.
+
+    """
+    fields = ((field.decode() if isinstance(field, bytes) else field, value) for field, value in data.items())
+
+    return {field: int(float(value)) for field, value in fields if field != 'strategy'}
+
+
+def _rebase_window(start, period, source, target):
+    """
+    Args:
+        start (int|None): Start of the window in nanoseconds on the source clock.
+        period (int): Period of the window in nanoseconds.
+        source (int): Time in nanoseconds on the source clock.
+        target (int): Same moment as ``source`` in nanoseconds on the target clock.
+
+    Returns:
+        int|None: Start of the window on the target clock, as many windows before the current one as it was.
+
+    """
+    if start is None:
+        return None
+
+    return target - target % period - (source - source % period - start)
+
+
+def _little_endian(values):
+    """
+    Args:
+        values (array.array): Native order values, swapped in place on big-endian hosts.
+
+    Returns:
+        array.array: The values in little-endian order, the same array.
+
+    """
+    if sys.byteorder == 'big':
+        values.byteswap()
+
+    return values
+
+
+class TickRing(object):
+    """
+    Fixed capacity ring buffer which keeps the most recent ticks of a key in a compact array, oldest first.
+
+    """
+    __slots__ = ('ticks', 'head', 'capacity')
+
+    def __init__(self, capacity, ticks=()):
+        """
+        Args:
+            capacity (int): Most ticks the ring keeps.
+            ticks (iterable): Initial ticks, oldest first.
+
+        """
+        ticks = list(ticks)
+
+        self.ticks = array('q', ticks[max(len(ticks) - capacity, 0):])
+        self.head = 0
+        self.capacity = capacity
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def __iter__(self):
+        yield from self.ticks[self.head:]
+        yield from self.ticks[:self.head]
+
+    def recent(self, n):
+        """
+        Args:
+            n (int): Position of the tick from the newest one, starts from 1.
+
+        Returns:
+            int: The n-th most recent tick.
+
+        """
+        return self.ticks[(self.head - n) % len(self.ticks)]
+
+    def append(self, tick):
+        """
+        Args:
+            tick (int): Newest tick, overwrites the oldest one when the ring is full.
+
+        """
+        if len(self.ticks) < self.capacity:
+            self.ticks.append(tick)
+
+        else:
+            self.ticks[self.head] = tick
+            self.head = (self.head + 1) % self.capacity
+
+    def to_bytes(self):
+        """
+        Returns:
+            bytes: Ticks packed as little-endian int64s, oldest first.
+
+        """
+        return _little_endian(self.ticks[self.head:] + self.ticks[:self.head]).tobytes()
+
+    @classmethod
+    def from_bytes(cls, capacity, data):
+        """
+        Args:
+            capacity (int): Most ticks the ring keeps.
+            data (bytes): Ticks packed by ``to_bytes``.
+
+        Returns:
+            TickRing: Ring of the most recent ticks which fit.
+
+        """
+        ticks = array('q')
+        ticks.frombytes(data)
+
+        return cls(capacity, _little_endian(ticks))
+
+    def resize(self, capacity):
+        """
+        Args:
+            capacity (int): New capacity, drops the oldest ticks which don't fit.
+
+        """
+        ticks = list(self)
+
+        self.ticks = array('q', ticks[max(len(ticks) - capacity, 0):])
+        self.head = 0
+        self.capacity = capacity
+
+
+class SlidingLog(Strategy):
+    """
+    Exact sliding window which keeps the most recent ticks per key, as many as the largest limitation count.
+
+    Memory is bounded by the largest limitation count, eight bytes per nanosecond tick. Redis keeps a tick as the
+    score of a 12 bytes member, its packed little-endian int64 microseconds and a random 32 bits which tells apart
+    ticks of the same microsecond.
+
+    """
+    name = 'sliding-log'
+    redis_type = 'zset'
+    script = """
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[5])
+
+        for i = 6, #ARGV, 2 do
+            if tonumber(ARGV[i]) <= redis.call('ZCOUNT', KEYS[1], '(' .. ARGV[i + 1], '+inf') then
+                return {0, -1}
+            end
+        end
+
+        if ARGV[2] == '0' then
+            return {1, -1}
+        end
+
+        redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+        redis.call('PEXPIRE', KEYS[1], ARGV[1])
+
+        return {1, -1}
+    """
+
+    def create(self, policy):
+        return TickRing(policy.capacity)
+
+    def arguments(self, policy, now):
+        now //= 1000
+        arguments = [now, pack('<qI', now, getrandbits(32)), now - self.ttl(policy) // 1000]
+
+        for limit_count, period in policy.windows:
+            arguments += limit_count, now - period // 1000
+
+        return arguments
+
+    def load(self, state):
+        return TickRing(len(state), state)
+
+    def dump(self, state):
+        return list(state)
+
+    def encode(self, state):
+        return state.to_bytes()
+
+    def decode(self, data):
+        return TickRing.from_bytes(len(data) // 8, data)
+
+    def size(self, policy):
+        return 8 * policy.capacity
+
+    def rebase(self, state, source, target):
+        return TickRing(state.capacity, (tick - source + target for tick in state))
+
+    def from_redis(self, data):
+        ticks = sorted(int(score) * 1000 for score in data.values())
+
+        return TickRing(len(ticks), ticks)
+
+    def to_redis(self, state):
+        return {pack('<qI', tick // 1000, getrandbits(32)): tick // 1000 for tick in state}
+
+    def hit(self, state, policy, now):
+        if state.capacity != policy.capacity:
+            state.resize(policy.capacity)
+
+        for limit_count, period in policy.windows:
+            position = ceil(limit_count)
+
+            if position <= len(state) and (not position or state.recent(position) > now - period):
+                return False
+
+        if state.capacity:
+            state.append(now)
+
+        return True
+
+
+class FixedWindow(Strategy):
+    """
+    Fixed window counter which keeps a window start and a counter per period of the policy.
+
+    Memory and time are constant per key, but up to twice the limit can pass around a window boundary.
+
+    """
+    name = 'fixed-window'
+    script = """
+        local counts = {}
+
+        for i = 3, #ARGV, 3 do
+            local window = redis.call('HMGET', KEYS[1], ARGV[i + 1], ARGV[i + 1] .. ':count')
+            local count = 0
+
+            if tonumber(window[1]) == tonumber(ARGV[i + 2]) then
+                count = tonumber(window[2])
+            end
+
+            if tonumber(ARGV[i]) <= count then
+                return {0, -1}
+            end
+
+            counts[#counts + 1] = count
+        end
+
+        if ARGV[2] == '0' then
+            return {1, -1}
+        end
+
+        for i = 3, #ARGV, 3 do
+            redis.call('HSET', KEYS[1], ARGV[i + 1], ARGV[i + 2], ARGV[i + 1] .. ':count', counts[i / 3] + 1)
+        end
+
+        redis.call('HSET', KEYS[1], 'strategy', 'fixed-window')
+        redis.call('PEXPIRE', KEYS[1], ARGV[1])
+
+        return {1, -1}
+    """
+    lease_script = """
+        local granted = tonumber(ARGV[2])
+        local unused = tonumber(ARGV[3])
+        local counts = {}
+
+        for i = 4, #ARGV, 4 do
+            local start = tonumber(ARGV[i + 2])
+            local window = redis.call('HMGET', KEYS[1], ARGV[i + 1], ARGV[i + 1] .. ':count')
+            local count = 0
+
+            if tonumber(window[1]) == start then
+                count = tonumber(window[2])
+
+                if tonumber(ARGV[i + 3]) == start then
+                    count = math.max(count - unused, 0)
+                end
+            end
+
+            granted = math.min(granted, math.ceil(tonumber(ARGV[i]) - count))
+            counts[#counts + 1] = count
+        end
+
+        granted = math.max(granted, 0)
+
+        for i = 4, #ARGV, 4 do
+            redis.call('HSET', KEYS[1], ARGV[i + 1], ARGV[i + 2], ARGV[i + 1] .. ':count', counts[i / 4] + granted)
+        end
+
+        redis.call('HSET', KEYS[1], 'strategy', 'fixed-window')
+        redis.call('PEXPIRE', KEYS[1], ARGV[1])
+
+        return granted
+    """
+
+    def create(self, policy):
+        return [[period, None, 0] for _, period in policy.windows]
+
+    def rebase(self, state, source, target):
+        return [[period, _rebase_window(start, period, source, target), count] for period, start, count in state]
+
+    def from_redis(self, data):
+        data = _fields(data)
+        periods = sorted(int(field) for field in data if ':' not in field)
+
+        return [
+            [period * 1000, data[str(period)] * 1000, data.get('{}:count'.format(period), 0)] for period in periods
+        ]
+
+    def to_redis(self, state):
+        data = dict()
+
+        for period, start, count in state:
+            if start is not None:
+                data[str(period // 1000)] = start // 1000
+                data['{}:count'.format(period // 1000)] = count
+
+        return data
+
+    def lease_arguments(self, policy, now, size, lease):
+        now //= 1000
+        acquired = None if lease is None else lease.acquired // 1000
+        arguments = [size, 0 if lease is None else lease.remaining]
+
+        for limit_count, period in policy.windows:
+            period //= 1000
+            leased = -1 if acquired is None else acquired - acquired % period
+            arguments += limit_count, period, now - now % period, leased
+
+        return arguments
+
+    def lease_expiry(self, policy, now):
+        return min((now - now % period + period for _, period in policy.windows), default=None)
+
+    def arguments(self, policy, now):
+        now //= 1000
+        arguments = list()
+
+        for limit_count, period in policy.windows:
+            period //= 1000
+            arguments += limit_count, period, now - now % period
+
+        return arguments
+
+    def hit(self, state, policy, now):
+        if len(state) != len(policy):
+            state[:] = self.create(policy)
+
+        for (limit_count, period), window in zip(policy.windows, state):
+            start = now - now % period
+
+            if window[0] != period or window[1] != start:
+                window[:] = period, start, 0
+
+            if limit_count <= window[2]:
+                return False
+
+        for window in state:
+            window[2] += 1
+
+        return True
+
+
+class SlidingWindow(Strategy):
+    """
+    Sliding window counter which weights the counter of the previous window by its overlap with the sliding window.
+
+    Memory and time are constant per key like the fixed window, and the estimation stays close to the sliding log as
+    long as the calls of the previous window are evenly spread.
+
+    """
+    name = 'sliding-window'
+    script = """
+        local windows = {}
+
+        for i = 3, #ARGV, 4 do
+            local start = tonumber(ARGV[i + 2])
+            local window = redis.call(
+                'HMGET', KEYS[1], ARGV[i + 1], ARGV[i + 1] .. ':current', ARGV[i + 1] .. ':previous'
+            )
+            local current, previous = 0, 0
+
+            if tonumber(window[1]) == start then
+                current, previous = tonumber(window[2]), tonumber(window[3])
+            elseif tonumber(window[1]) == start - tonumber(ARGV[i + 1]) then
+                previous = tonumber(window[2])
+            end
+
+            if tonumber(ARGV[i]) <= current + previous * tonumber(ARGV[i + 3]) then
+                return {0, -1}
+            end
+
+            windows[#windows + 1] = {current, previous}
+        end
+
+        if ARGV[2] == '0' then
+            return {1, -1}
+        end
+
+        for i = 3, #ARGV, 4 do
+            local window = windows[(i + 1) / 4]
+
+            redis.call(
+                'HSET', KEYS[1], ARGV[i + 1], ARGV[i + 2],
+                ARGV[i + 1] .. ':current', window[1] + 1, ARGV[i + 1] .. ':previous', window[2]
+            )
+        end
+
+        redis.call('HSET', KEYS[1], 'strategy', 'sliding-window')
+        redis.call('PEXPIRE', KEYS[1], ARGV[1])
+
+        return {1, -1}
+    """
+
+    def create(self, policy):
+        return [[period, None, 0, 0] for _, period in policy.windows]
+
+    def rebase(self, state, source, target):
+        return [
+            [period, _rebase_window(start, period, source, target), current, previous]
+            for period, start, current, previous in state
+        ]
+
+    def from_redis(self, data):
+        data = _fields(data)
+        periods = sorted(int(field) for field in data if ':' not in field)
+
+        return [
+            [
+                period * 1000, data[str(period)] * 1000,
+                data.get('{}:current'.format(period), 0), data.get('{}:previous'.format(period), 0)
+            ]
+            for period in periods
+        ]
+
+    def to_redis(self, state):
+        data = dict()
+
+        for period, start, current, previous in state:
+            if start is not None:
+                data[str(period // 1000)] = start // 1000
+                data['{}:current'.format(period // 1000)] = current
+                data['{}:previous'.format(period // 1000)] = previous
+
+        return data
+
+    def arguments(self, policy, now):
+        now //= 1000
+        arguments = list()
+
+        for limit_count, period in policy.windows:
+            period //= 1000
+            start = now - now % period
+            arguments += limit_count, period, start, (period - now + start) / period
+
+        return arguments
+
+    def ttl(self, policy):
+        return 2 * super().ttl(policy)
+
+    def hit(self, state, policy, now):
+        if len(state) != len(policy):
+            state[:] = self.create(policy)
+
+        for (limit_count, period), window in zip(policy.windows, state):
+            start = now - now % period
+
+            if window[0] != period:
+                window[:] = period, start, 0, 0
+
+            elif window[1] != start:
+                previous = window[2] if window[1] == start - period else 0
+                window[1:] = start, 0, previous
+
+            if limit_count <= window[2] + window[3] * (period - now + start) / period:
+                return False
+
+        for window in state:
+            window[2] += 1
+
+        return True
+
+
+class GCRA(Strategy):
+    """
+    Generic cell rate algorithm, a token bucket which keeps only the theoretical arrival time per period.
+
+    Each limitation ``count/period`` lets a call through every ``period / count`` seconds and tolerates ``burst`` calls
+    back to back, the limitation count by default. A limitation count of zero denies every call.
+
+    """
+    name = 'gcra'
+    script = """
+        local now = tonumber(ARGV[3])
+        local arrivals = {}
+        local retry_after = 0
+
+        for i = 4, #ARGV, 3 do
+            if tonumber(ARGV[i + 1]) < 0 then
+                return {0, -1}
+            end
+
+            local arrival = math.max(tonumber(redis.call('HGET', KEYS[1], ARGV[i]) or now), now) + tonumber(ARGV[i + 1])
+
+            retry_after = math.max(retry_after, arrival - tonumber(ARGV[i + 2]) - now)
+            arrivals[#arrivals + 1] = arrival
+        end
+
+        if retry_after > 0 then
+            return {0, retry_after}
+        end
+
+        if ARGV[2] == '0' then
+            return {1, -1}
+        end
+
+        for i = 4, #ARGV, 3 do
+            redis.call('HSET', KEYS[1], ARGV[i], arrivals[(i - 1) / 3])
+        end
+
+        redis.call('HSET', KEYS[1], 'strategy', 'gcra')
+        redis.call('PEXPIRE', KEYS[1], ARGV[1])
+
+        return {1, -1}
+    """
+
+    def __init__(self, burst=None):
+        """
+        Args:
+            burst (int|float|None): Calls which can pass back to back, the limitation count if it isn't defined.
+
+        Raises:
+            ValueError (ValueError): When burst is less than one call.
+
+        """
+        if burst is not None and burst < 1:
+            raise ValueError('Burst should be at least one call, got {}'.format(burst))
+
+        self.burst = burst
+
+    def create(self, policy):
+        return [[period, None] for _, period in policy.windows]
+
+    def rebase(self, state, source, target):
+        return [[period, None if arrival is None else arrival - source + target] for period, arrival in state]
+
+    def from_redis(self, data):
+        data = _fields(data)
+
+        return [[period * 1000, data[str(period)] * 1000] for period in sorted(map(int, data))]
+
+    def to_redis(self, state):
+        return {str(period // 1000): arrival // 1000 for period, arrival in state if arrival is not None}
+
+    def arguments(self, policy, now):
+        arguments = [now // 1000]
+
+        for limit_count, period in policy.windows:
+            if not limit_count:
+                arguments += period // 1000, -1, 0
+                continue
+
+            emission, tolerance = self.__tolerance(limit_count, period)
+            arguments += period // 1000, emission // 1000, tolerance // 1000
+
+        return arguments
+
+    def ttl(self, policy):
+        return max(
+            (self.__tolerance(limit_count, period)[1] for limit_count, period in policy.windows if limit_count),
+            default=0
+        )
+
+    def __tolerance(self, limit_count, period):
+        burst = max(limit_count, 1) if self.burst is None else self.burst
+
+        return round(period / limit_count), round(period * burst / limit_count)
+
+    def hit(self, state, policy, now):
+        if len(state) != len(policy):
+            state[:] = self.create(policy)
+
+        arrivals = list()
+
+        for (limit_count, period), cell in zip(policy.windows, state):
+            if cell[0] != period:
+                cell[:] = period, None
+
+            if not limit_count:
+                return False
+
+            emission, tolerance = self.__tolerance(limit_count, period)
+            arrival = (now if cell[1] is None else max(cell[1], now)) + emission
+
+            if arrival - now > tolerance:
+                return False
+
+            arrivals.append(arrival)
+
+        for cell, arrival in zip(state, arrivals):
+            cell[1] = arrival
+
+        return True
+
+    def retry_after(self, state, policy, now):
+        retry = 0
+
+        for (limit_count, period), (_, arrival) in zip(policy.windows, state):
+            if not limit_count:
+                return None
+
+            if arrival is not None:
+                emission, tolerance = self.__tolerance(limit_count, period)
+                retry = max(retry, arrival + emission - tolerance - now)
+
+        return retry
+
+
+strategies = {
+    SlidingLog.name: SlidingLog(),
+    FixedWindow.name: FixedWindow(),
+    SlidingWindow.name: SlidingWindow(),
+    GCRA.name: GCRA(),
+}
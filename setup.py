@@ -25,7 +25,7 @@ setup(
     version=versioneer.get_version(),
     cmdclass=versioneer.get_cmdclass(),
     classifiers=[k for k in open('CLASSIFIERS').read().split('\n') if k],
-    install_requires=list(REQUIREMENTS),
+    extras_require={'redis': list(REQUIREMENTS)},
     long_description=open('README.rst').read(),
     long_description_content_type='text/x-rst',
     description='Rate limiting for callable functions',
@@ -1,13 +1,44 @@
 import asyncio
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
 import time
 from contextlib import suppress
-from multiprocessing import Process
+from multiprocessing import Process, Value
+from multiprocessing.pool import ThreadPool
 from unittest import TestCase, IsolatedAsyncioTestCase
+from uuid import uuid4
 
 import redis
-
+import redis.asyncio
+
+from function_limiter import AsyncFallbackStorage
+from function_limiter import AsyncRedisStorage
+from function_limiter import FallbackStorage
+from function_limiter import FixedWindow
+from function_limiter import GCRA
+from function_limiter import Lease
 from function_limiter import Limiter
+from function_limiter import MappedFileStorage
+from function_limiter import MemoryStorage
+from function_limiter import Policy
 from function_limiter import RateLimitExceeded
+from function_limiter import RedisStorage
+from function_limiter import SlidingLog
+from function_limiter import SQLiteStorage
+from function_limiter import SharedMemoryStorage
+from function_limiter import SlidingWindow
+from function_limiter import Storage
+from function_limiter import TickRing
+from function_limiter import VirtualClock
+from function_limiter import compile_limitations
+from function_limiter import read_records
+
+second = 10 ** 9
 
 
 class TestSimpleFiveRequest(TestCase):
@@ -58,7 +89,8 @@ class TestSimpleFiveRequest(TestCase):
 class TestMultipleLimitations(TestCase):
 
     def test_single_line_limitations(self):
-        limiter = Limiter()
+        clock = VirtualClock()
+        limiter = Limiter(clock=clock)
 
         @limiter.limit('1/second;3/minute', 'key')
         def func():
@@ -68,7 +100,7 @@ class TestMultipleLimitations(TestCase):
 
         for i in range(3):
             func()
-            time.sleep(1)
+            clock.advance(1)
 
         self.assertEqual(2, i)
 
@@ -88,7 +120,8 @@ class TestMultipleLimitations(TestCase):
         self.assertEqual(1, i)
 
     def test_single_line_limitations_more_than_second_limitation(self):
-        limiter = Limiter()
+        clock = VirtualClock()
+        limiter = Limiter(clock=clock)
 
         @limiter.limit('1/second;3/minute', 'key')
         def func():
@@ -99,7 +132,7 @@ class TestMultipleLimitations(TestCase):
         with self.assertRaises(RateLimitExceeded):
             for i in range(4):
                 func()
-                time.sleep(1)
+                clock.advance(1)
 
         self.assertEqual(3, i)
 
@@ -317,8 +350,11 @@ class TestRedis(TestCase):
     def tearDown(self):
         storage = redis.from_url(url='redis://127.0.0.1:6379/', db=0)
 
-        storage.delete('function-limiter')
-        storage.delete('custom_database_name')
+        for name in storage.scan_iter('function-limiter:*'):
+            storage.delete(name)
+
+        for name in storage.scan_iter('custom_database_name:*'):
+            storage.delete(name)
 
     def test_redis_for_single_instance(self):
         limiter = Limiter(
@@ -379,6 +415,242 @@ class TestRedis(TestCase):
 
         self.assertEqual(3, i)
 
+    def test_redis_key_layout(self):
+        storage = redis.Redis()
+        limiter = Limiter(
+            redis_storage=storage
+        )
+
+        @limiter.limit('3/minute;10/hour', 'layout-key')
+        def func():
+            pass
+
+        @limiter.limit('3/minute', 'other-layout-key', strategy='fixed-window')
+        def other_func():
+            pass
+
+        func()
+        func()
+        other_func()
+
+        self.assertEqual(b'zset', storage.type('function-limiter:{layout-key}'))
+        self.assertEqual(2, storage.zcard('function-limiter:{layout-key}'))
+        self.assertEqual(
+            [12, 12], [len(member) for member in storage.zrange('function-limiter:{layout-key}', 0, -1)]
+        )
+        self.assertEqual(b'hash', storage.type('function-limiter:{other-layout-key}'))
+
+    def test_redis_atomic_decision(self):
+        limiter = Limiter(
+            redis_storage=redis.Redis()
+        )
+
+        @limiter.limit('50/minute', 'atomic-key')
+        def func():
+            return True
+
+        def call(_):
+            with suppress(RateLimitExceeded):
+                return func()
+
+        with ThreadPool(8) as pool:
+            self.assertEqual(50, sum(filter(None, pool.map(call, range(100)))))
+
+    def test_redis_strategies(self):
+        limiter = Limiter(
+            redis_storage=redis.Redis()
+        )
+
+        for strategy in ('sliding-log', 'fixed-window', 'sliding-window', 'gcra'):
+            @limiter.limit('3/minute;5/hour', 'strategy-' + strategy, strategy=strategy)
+            def func():
+                pass
+
+            i = 0
+
+            with self.assertRaises(RateLimitExceeded) as context:
+                for i in range(4):
+                    func()
+
+            self.assertEqual(3, i)
+
+        self.assertAlmostEqual(20, context.exception.retry_after, delta=1)
+
+    def test_redis_key_expiry(self):
+        storage = redis.Redis()
+        limiter = Limiter(
+            redis_storage=storage
+        )
+
+        for strategy in ('sliding-log', 'fixed-window', 'sliding-window', 'gcra'):
+            @limiter.limit('3/second;10/minute', 'expiry-' + strategy, strategy=strategy)
+            def func():
+                pass
+
+            func()
+
+            self.assertLessEqual(storage.pttl('function-limiter:{expiry-' + strategy + '}'), 2 * 60 * 1000)
+            self.assertGreater(storage.pttl('function-limiter:{expiry-' + strategy + '}'), 59 * 1000)
+
+    def test_redis_lease(self):
+        storage = redis.Redis()
+        clock = VirtualClock(time.time_ns())
+        limiters = [
+            Limiter(redis_storage=storage, strategy='fixed-window', clock=clock, lease=0.1) for _ in range(2)
+        ]
+        functions = [limiter.limit('100/hour', 'lease-key')(lambda: True) for limiter in limiters]
+        evalsha = storage.evalsha
+        round_trips = list()
+
+        def counted_evalsha(*args):
+            round_trips.append(args)
+            return evalsha(*args)
+
+        storage.evalsha = counted_evalsha
+        permitted = 0
+
+        for i in range(300):
+            with suppress(RateLimitExceeded):
+                permitted += functions[i % 2]()
+
+            clock.advance(0.001)
+
+        self.assertEqual(100, permitted)
+        self.assertLess(len(round_trips), 40)
+
+    def test_redis_lease_give_back(self):
+        storage = redis.Redis()
+        clock = VirtualClock(time.time_ns() // 3600 // 10 ** 9 * 3600 * 10 ** 9)
+        limiter = Limiter(redis_storage=storage, strategy='fixed-window', clock=clock, lease=0.5, lease_ttl=1)
+
+        @limiter.limit('100/hour', 'give-back-key')
+        def func():
+            pass
+
+        for _ in range(20):
+            func()
+            clock.advance(0.01)
+
+        leased = int(storage.hget('function-limiter:{give-back-key}', '3600000000:count'))
+        clock.advance(1)
+        func()
+
+        self.assertGreater(leased, 21)
+        self.assertLess(int(storage.hget('function-limiter:{give-back-key}', '3600000000:count')), leased)
+
+    def test_redis_lease_expiry(self):
+        storage = RedisStorage(redis.Redis(), lease=0.5, lease_ttl=0.05)
+        leased = Limiter(storage=storage, strategy='fixed-window').limit('100/hour', 'expiry-lease-key')(lambda: True)
+        func = Limiter(redis_storage=redis.Redis(), strategy='fixed-window').limit('100/hour', 'expiry-lease-key')(
+            lambda: True
+        )
+
+        for _ in range(10):
+            leased()
+
+        self.assertTrue(storage._leases)
+
+        time.sleep(0.3)
+        permitted = 0
+
+        for _ in range(100):
+            with suppress(RateLimitExceeded):
+                permitted += func()
+
+        self.assertFalse(storage._leases)
+        self.assertEqual(90, permitted)
+
+    def test_redis_release(self):
+        storage = RedisStorage(redis.Redis(), lease=0.5, lease_ttl=1)
+        policy = compile_limitations('100/hour')
+        now = storage.clock() // (3600 * 10 ** 9) * 3600 * 10 ** 9
+
+        for key in 'release-key-1', 'release-key-2':
+            for i in range(3):
+                storage.acquire(key, policy, FixedWindow(), now + i)
+
+        released = sum(lease.remaining for lease in storage._leases.values())
+
+        self.assertGreater(released, 0)
+
+        self.assertEqual(0, storage.release(now))
+        self.assertEqual(released, storage.release(now + 2 * 10 ** 9))
+        self.assertFalse(storage._leases)
+
+        for key in 'release-key-1', 'release-key-2':
+            self.assertEqual(3, int(redis.Redis().hget('function-limiter:{' + key + '}', '3600000000:count')))
+
+    def test_redis_invalidation(self):
+        storages = [RedisStorage(redis.Redis(), lease=0.5, invalidation=True) for _ in range(2)]
+        policy = compile_limitations('100/hour')
+        now = storages[0].clock()
+
+        for _ in range(5):
+            storages[0].acquire('invalidation-key', policy, FixedWindow(), now + 1)
+
+        self.assertIn('invalidation-key', storages[0]._leases)
+
+        storages[1].reset('invalidation-key')
+        time.sleep(0.1)
+
+        self.assertNotIn('invalidation-key', storages[0]._leases)
+
+        for storage in storages:
+            storage.close()
+
+    def test_redis_lease_invalidation(self):
+        limiters = [
+            Limiter(redis_storage=redis.Redis(), strategy='fixed-window', lease=0.5),
+            Limiter(redis_storage=redis.Redis(), strategy='fixed-window', lease=0.5, invalidation=False),
+            Limiter(redis_storage=redis.Redis(), strategy='fixed-window'),
+        ]
+
+        self.assertEqual([True, False, False], [limiter.storage.invalidation for limiter in limiters])
+
+        limiter = limiters[0]
+        func = limiter.limit('100/hour', 'lease-invalidation-key')(lambda: True)
+
+        for _ in range(5):
+            func()
+
+        self.assertIn('lease-invalidation-key', limiter.storage._leases)
+
+        other = RedisStorage(redis.Redis(), invalidation=True)
+        other.reset('lease-invalidation-key')
+        time.sleep(0.1)
+
+        self.assertNotIn('lease-invalidation-key', limiter.storage._leases)
+
+        for storage in [other] + [limiter.storage for limiter in limiters]:
+            storage.close()
+
+    def test_redis_invalidation_race(self):
+        storage = RedisStorage(redis.Redis(), lease=0.5)
+        policy = compile_limitations('100/hour')
+        keys = ['race-key-{}'.format(i) for i in range(1000)]
+        stopped = threading.Event()
+
+        def receive():
+            while not stopped.is_set():
+                with storage._lock:
+                    for key in keys:
+                        storage._leases[key] = Lease(policy, FixedWindow(), 1, 0, 10 ** 18)
+
+                storage._receive({'data': json.dumps({'origin': 'other', 'keys': keys})})
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(10 ** -6)
+        thread = threading.Thread(target=receive)
+        thread.start()
+
+        try:
+            for _ in range(200):
+                storage.reset_matching('race-key-*')
+        finally:
+            stopped.set()
+            thread.join()
+            sys.setswitchinterval(interval)
+
     def test_redis_custom_database_name(self):
         limiter = Limiter(
             database_name='custom_database_name',
@@ -430,7 +702,8 @@ class TestWrongInput(TestCase):
 
 class TestGarbageCollector(TestCase):
     def test_garbage_collector_with_garbage(self):
-        limiter = Limiter()
+        clock = VirtualClock()
+        limiter = Limiter(clock=clock)
 
         @limiter.limit('1/second', 'key')
         def func():
@@ -440,7 +713,7 @@ class TestGarbageCollector(TestCase):
 
         for i in range(4):
             func()
-            time.sleep(1)
+            clock.advance(1)
 
         self.assertEqual(3, i)
 
@@ -503,21 +776,1064 @@ class TestLimitationRest(TestCase):
         with suppress(redis.exceptions.ConnectionError):
             storage = redis.Redis()
 
-            storage.delete('function-limiter')
-            storage.delete('custom_database_name')
+            for name in storage.scan_iter('function-limiter:*'):
+                storage.delete(name)
 
 
-class TestAsyncLimiter(IsolatedAsyncioTestCase):
-    async def test_async_limiter(self):
+class TestSlidingLog(TestCase):
+    def test_ring_log(self):
+        limiter = Limiter()
+
+        @limiter.limit('100/minute;1000/hour', 'key')
+        def func():
+            pass
+
+        with self.assertRaises(RateLimitExceeded):
+            for _ in range(101):
+                func()
+
+        self.assertIsInstance(limiter.logs['key'], TickRing)
+        self.assertEqual(1000, limiter.logs['key'].capacity)
+        self.assertEqual(100, len(limiter.logs['key']))
+        self.assertEqual(sorted(limiter.logs['key']), list(limiter.logs['key']))
+
+    def test_ring_capacity(self):
+        strategy = SlidingLog()
+        policy = compile_limitations('3/second')
+        state = strategy.create(policy)
+
+        for tick in range(10):
+            self.assertTrue(strategy.hit(state, policy, tick * second))
+
+        self.assertEqual([7 * second, 8 * second, 9 * second], list(state))
+
+        for _ in range(3):
+            self.assertTrue(strategy.hit(state, policy, 20 * second))
+
+        self.assertFalse(strategy.hit(state, policy, 20 * second + second // 2))
+        self.assertEqual([20 * second] * 3, list(state))
+
+    def test_ring_resize(self):
+        ring = TickRing(3, range(5))
+
+        self.assertEqual([2, 3, 4], list(ring))
+
+        ring.append(5)
+        ring.resize(2)
+
+        self.assertEqual([4, 5], list(ring))
+        self.assertEqual(4, ring.recent(2))
+
+    def test_ring_bytes(self):
+        ring = TickRing(3, range(5))
+        ring.append(5)
+
+        self.assertEqual(24, len(ring.to_bytes()))
+        self.assertEqual((3).to_bytes(8, 'little'), ring.to_bytes()[:8])
+        self.assertEqual([3, 4, 5], list(TickRing.from_bytes(3, ring.to_bytes())))
+        self.assertEqual([4, 5], list(TickRing.from_bytes(2, ring.to_bytes())))
+
+    def test_encoding(self):
+        policy = compile_limitations('3/second;5/minute')
+
+        for strategy in SlidingLog(), FixedWindow(), SlidingWindow(), GCRA():
+            state = strategy.create(policy)
+            data = strategy.encode(state)
+
+            self.assertEqual(strategy.dump(state), strategy.dump(strategy.decode(data)))
+
+            for i in range(4):
+                strategy.hit(state, policy, i * second // 10)
+
+            data = strategy.encode(state)
+
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(strategy.dump(state), strategy.dump(strategy.decode(data)))
+
+
+class TestFixedWindow(TestCase):
+    def test_fixed_window(self):
+        limiter = Limiter(strategy='fixed-window')
+
+        @limiter.limit('3/minute;5/hour', 'key')
+        def func():
+            pass
+
+        i = 0
+
+        with self.assertRaises(RateLimitExceeded):
+            for i in range(4):
+                func()
+
+        self.assertEqual(3, i)
+        self.assertEqual([3, 3], [count for _, _, count in limiter.logs['key']])
+
+    def test_fixed_window_new_window(self):
+        clock = VirtualClock()
+        limiter = Limiter(clock=clock)
+
+        @limiter.limit('1/second', 'key', strategy='fixed-window')
+        def func():
+            pass
+
+        func()
+        clock.advance(1)
+        func()
+
+        self.assertEqual(1, limiter.logs['key'][0][2])
+
+    def test_redis_fixed_window(self):
+        limiter = Limiter(
+            redis_storage=redis.Redis(),
+            strategy='fixed-window'
+        )
+
+        @limiter.limit('3/minute', 'fixed-window-key')
+        def func():
+            pass
+
+        i = 0
+
+        with self.assertRaises(RateLimitExceeded):
+            for i in range(4):
+                func()
+
+        self.assertEqual(3, i)
+
+    def tearDown(self):
+        with suppress(redis.exceptions.ConnectionError):
+            redis.Redis().delete('function-limiter:{fixed-window-key}')
+
+
+class TestSlidingWindow(TestCase):
+    def test_weighted_previous_window(self):
+        strategy = SlidingWindow()
+        policy = compile_limitations('10/minute')
+        state = strategy.create(policy)
+        start = 60 * 1000 * second
+
+        for _ in range(10):
+            self.assertTrue(strategy.hit(state, policy, start + 30 * second))
+
+        self.assertFalse(strategy.hit(state, policy, start + 59 * second))
+
+        for _ in range(5):
+            self.assertTrue(strategy.hit(state, policy, start + 90 * second))
+
+        self.assertFalse(strategy.hit(state, policy, start + 90 * second))
+        self.assertTrue(strategy.hit(state, policy, start + 150 * second))
+
+    def test_sliding_window(self):
         limiter = Limiter()
 
+        @limiter.limit('3/minute;10 per hour', 'key', strategy='sliding-window')
+        def func():
+            pass
+
+        i = 0
+
+        with self.assertRaises(RateLimitExceeded):
+            for i in range(4):
+                func()
+
+        self.assertEqual(3, i)
+
+
+class TestGCRA(TestCase):
+    def test_gcra(self):
+        limiter = Limiter(strategy='gcra')
+
         @limiter.limit('3/minute', 'key')
-        async def func():
-            await asyncio.sleep(0.5)
+        def func():
+            pass
 
         i = 0
-        with suppress(RateLimitExceeded):
-            for i in range(10):
-                await func()
+
+        with self.assertRaises(RateLimitExceeded) as context:
+            for i in range(4):
+                func()
 
         self.assertEqual(3, i)
+        self.assertAlmostEqual(20, context.exception.retry_after, delta=1)
+
+    def test_gcra_burst(self):
+        strategy = GCRA(burst=1)
+        policy = compile_limitations('2/second')
+        state = strategy.create(policy)
+
+        self.assertTrue(strategy.hit(state, policy, 100 * second))
+        self.assertFalse(strategy.hit(state, policy, 100 * second + second // 4))
+        self.assertEqual(second // 4, strategy.retry_after(state, policy, 100 * second + second // 4))
+        self.assertTrue(strategy.hit(state, policy, 100 * second + second // 2))
+
+    def test_gcra_fractional_rate(self):
+        strategy = GCRA()
+        policy = compile_limitations('0.5/second')
+        state = strategy.create(policy)
+
+        self.assertTrue(strategy.hit(state, policy, 100 * second))
+        self.assertFalse(strategy.hit(state, policy, 101 * second))
+        self.assertTrue(strategy.hit(state, policy, 102 * second))
+
+    def test_gcra_zero_count(self):
+        for limiter in Limiter(strategy='gcra'), Limiter(redis_storage=redis.Redis(), strategy='gcra'):
+            for limitations in '0/second', '5/minute;0/second':
+                func = limiter.limit(limitations, 'gcra-zero-key')(lambda: True)
+
+                with self.assertRaises(RateLimitExceeded) as context:
+                    func()
+
+                self.assertIsNone(context.exception.retry_after)
+
+            limiter.reset('gcra-zero-key')
+
+    def test_gcra_invalid_burst(self):
+        for burst in 0, 0.5, -1:
+            with self.assertRaises(ValueError):
+                GCRA(burst=burst)
+
+
+class TestKeyEviction(TestCase):
+    def test_max_keys(self):
+        limiter = Limiter(max_keys=2)
+
+        @limiter.limit('3/minute', lambda: key)
+        def func():
+            pass
+
+        for key in ('first', 'second', 'first', 'third'):
+            func()
+
+        self.assertEqual(['first', 'third'], list(limiter.logs))
+
+    def test_expired_keys(self):
+        clock = VirtualClock()
+        limiter = Limiter(clock=clock)
+
+        @limiter.limit('1/second', lambda: key)
+        def func():
+            pass
+
+        key = 'first'
+        func()
+        clock.advance(1)
+        key = 'second'
+        func()
+
+        self.assertEqual(['second'], list(limiter.logs))
+
+    def test_idle_ttl(self):
+        clock = VirtualClock()
+        limiter = Limiter(idle_ttl=0.1, clock=clock)
+
+        @limiter.limit('3/minute', lambda: key)
+        def func():
+            pass
+
+        key = 'first'
+        func()
+        clock.advance(0.1)
+        key = 'second'
+        func()
+
+        self.assertEqual(['second'], list(limiter.logs))
+
+    def test_mixed_policies(self):
+        clock = VirtualClock()
+        limiter = Limiter(clock=clock)
+
+        limiter.limit('1/day', 'daily')(lambda: True)()
+
+        for i in range(1000):
+            limiter.limit('1/second', 'caller-{}'.format(i))(lambda: True)()
+            clock.advance(1)
+
+        self.assertEqual(['daily', 'caller-999'], list(limiter.logs))
+
+    def test_imported_keys(self):
+        clock = VirtualClock()
+        limiter = Limiter(clock=clock)
+
+        limiter.limit('1/day', 'long')(lambda: True)()
+        limiter.limit('1/second', 'short')(lambda: True)()
+
+        target = Limiter(storage=MemoryStorage(stripes=1), clock=VirtualClock())
+        target.import_state(list(limiter.export_state()))
+        target.clock.advance(10)
+        target.limit('1/minute', 'other')(lambda: True)()
+
+        self.assertEqual(['long', 'other'], list(target.logs))
+
+
+class TestCompiledLimitations(TestCase):
+    def test_compile_limitations(self):
+        policy = compile_limitations('3/second;10 per minute, 2/5hour')
+
+        self.assertIsInstance(policy, Policy)
+        self.assertEqual(((3, 1), (10, 60), (2, 5 * 60 * 60)), policy)
+        self.assertEqual(5 * 60 * 60, policy.period)
+
+    def test_compile_wrong_limitations(self):
+        self.assertEqual(Policy(), compile_limitations('3/second;wrong input'))
+        self.assertEqual(Policy(), compile_limitations(0))
+
+    def test_compile_limitations_cached(self):
+        self.assertIs(compile_limitations('7 per minute'), compile_limitations('7 per minute'))
+
+
+class TestThreadSafety(TestCase):
+    def setUp(self):
+        self.interval = sys.getswitchinterval()
+        sys.setswitchinterval(10 ** -6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.interval)
+
+    def test_threads(self):
+        limiter = Limiter(storage=MemoryStorage(max_keys=8, stripes=4))
+
+        for strategy in ('sliding-log', 'fixed-window', 'sliding-window', 'gcra'):
+            funcs = [
+                limiter.limit('50/minute', 'thread-%s-%d' % (strategy, i), strategy=strategy)(lambda: True)
+                for i in range(4)
+            ]
+
+            def call(i):
+                with suppress(RateLimitExceeded):
+                    return funcs[i % 4]()
+
+            with ThreadPool(16) as pool:
+                self.assertEqual(200, sum(filter(None, pool.map(call, range(400)))))
+
+
+class TestStorages(TestCase):
+    def tearDown(self):
+        storage = redis.Redis()
+        for name in storage.scan_iter('function-limiter:*'):
+            storage.delete(name)
+
+    def test_storage(self):
+        storage = MemoryStorage()
+        limiter = Limiter(storage=storage)
+
+        @limiter.limit('3/minute', 'key')
+        def func():
+            pass
+
+        for _ in range(3):
+            func()
+
+        self.assertIs(storage.logs, limiter.logs)
+
+        with self.assertRaises(RateLimitExceeded):
+            func()
+
+    def test_peek(self):
+        policy = compile_limitations('2/minute')
+
+        for storage in MemoryStorage(), RedisStorage(redis.Redis()):
+            for strategy in SlidingLog(), FixedWindow(), SlidingWindow(), GCRA():
+                storage.reset('key')
+                now = storage.clock()
+
+                self.assertTrue(storage.peek('key', policy, strategy, now))
+                self.assertTrue(storage.peek('key', policy, strategy, now))
+                self.assertEqual((True, None), storage.acquire('key', policy, strategy, now))
+                self.assertTrue(storage.acquire('key', policy, strategy, now)[0])
+                self.assertFalse(storage.peek('key', policy, strategy, now))
+                self.assertFalse(storage.acquire('key', policy, strategy, now)[0])
+
+    def test_reset_many(self):
+        policy = compile_limitations('1/minute')
+
+        for storage in MemoryStorage(), RedisStorage(redis.Redis()):
+            now = storage.clock()
+
+            for key in 'first', 'second', 'third':
+                storage.acquire(key, policy, SlidingLog(), now)
+
+            storage.reset_many(['first', 'second'])
+
+            self.assertTrue(storage.peek('first', policy, SlidingLog(), now))
+            self.assertTrue(storage.peek('second', policy, SlidingLog(), now))
+            self.assertFalse(storage.peek('third', policy, SlidingLog(), now))
+
+    def test_reset_matching(self):
+        for limiter in Limiter(), Limiter(redis_storage=redis.Redis()):
+            functions = {
+                key: limiter.limit('1/minute', key)(lambda: True) for key in ('tenant-1', 'tenant-2', 'other')
+            }
+
+            for func in functions.values():
+                func()
+
+            self.assertEqual(2, limiter.reset_matching('tenant-*'))
+
+            functions['tenant-1']()
+            functions['tenant-2']()
+
+            with self.assertRaises(RateLimitExceeded):
+                functions['other']()
+
+            limiter.reset_many(['tenant-1', 'tenant-2', 'other'])
+
+            for func in functions.values():
+                func()
+
+    def test_reset_matching_batches(self):
+        storage = RedisStorage(redis.Redis())
+        storage.batch = 10
+        policy = compile_limitations('1/minute')
+        now = storage.clock()
+
+        for i in range(35):
+            storage.acquire('batch-{}'.format(i), policy, SlidingLog(), now)
+
+        self.assertEqual(35, storage.reset_matching('batch-*'))
+        self.assertEqual([], list(redis.Redis().scan_iter('function-limiter:{batch-*}')))
+
+    def test_custom_storage(self):
+        class DenyingStorage(Storage):
+            def acquire(self, key, policy, strategy, now):
+                return False, second
+
+        limiter = Limiter(storage=DenyingStorage())
+
+        @limiter.limit('3/minute', 'key')
+        def func():
+            pass
+
+        with self.assertRaises(RateLimitExceeded) as context:
+            func()
+
+        self.assertEqual(1, context.exception.retry_after)
+        self.assertIsNone(limiter.logs)
+
+
+class UnhealthyStorage(Storage):
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.down = True
+
+    def acquire(self, key, policy, strategy, now):
+        time.sleep(self.delay)
+
+        if self.down:
+            raise ConnectionError
+
+        return True, None
+
+    def reset(self, key):
+        if self.down:
+            raise ConnectionError
+
+    def reset_matching(self, pattern):
+        if self.down:
+            raise ConnectionError
+
+        return 0
+
+    def ping(self):
+        if self.down:
+            raise ConnectionError
+
+        return True
+
+
+class AsyncUnhealthyStorage(UnhealthyStorage):
+    asynchronous = True
+
+    async def acquire(self, key, policy, strategy, now):
+        await asyncio.sleep(self.delay)
+
+        if self.down:
+            raise ConnectionError
+
+        return True, None
+
+    async def reset(self, key):
+        return super().reset(key)
+
+    async def reset_many(self, keys):
+        return super().reset_many(keys)
+
+    async def reset_matching(self, pattern):
+        return super().reset_matching(pattern)
+
+    async def ping(self):
+        return super().ping()
+
+
+def shared_memory_worker(name, permitted):
+    storage = SharedMemoryStorage(name, slots=64)
+    limiter = Limiter(storage=storage)
+
+    @limiter.limit('50/minute', 'shared-key')
+    def func():
+        pass
+
+    for _ in range(20):
+        with suppress(RateLimitExceeded):
+            func()
+
+            with permitted.get_lock():
+                permitted.value += 1
+
+    storage.close()
+
+
+class TestSharedMemoryStorage(TestCase):
+    def setUp(self):
+        self.storage = SharedMemoryStorage('function-limiter-' + uuid4().hex[:8], slots=64)
+
+    def tearDown(self):
+        self.storage.close()
+        self.storage.unlink()
+
+    def test_multiple_processes(self):
+        permitted = Value('i', 0)
+        processes = [
+            Process(target=shared_memory_worker, args=(self.storage.memory.name, permitted)) for _ in range(4)
+        ]
+
+        for process in processes:
+            process.start()
+
+        for process in processes:
+            process.join()
+
+        self.assertEqual(50, permitted.value)
+        self.assertFalse(self.storage.peek('shared-key', compile_limitations('50/minute'), SlidingLog(), 0))
+
+    def test_strategies(self):
+        clock = VirtualClock()
+        policy = compile_limitations('3/second')
+
+        for strategy in SlidingLog(), FixedWindow(), SlidingWindow(), GCRA():
+            limiter = Limiter(storage=self.storage, strategy=strategy, clock=clock)
+            func = limiter.limit(policy, strategy.name)(lambda: True)
+
+            for _ in range(3):
+                func()
+
+            with self.assertRaises(RateLimitExceeded):
+                func()
+
+            clock.advance(2)
+            func()
+
+    def test_full_window(self):
+        storage = SharedMemoryStorage('function-limiter-' + uuid4().hex[:8], slots=2, probes=2)
+        policy = compile_limitations('1/minute')
+
+        try:
+            for key in 'first', 'second', 'third':
+                self.assertEqual((True, None), storage.acquire(key, policy, SlidingLog(), 0))
+
+            self.assertTrue(storage.peek('first', policy, SlidingLog(), 0))
+            self.assertFalse(storage.peek('third', policy, SlidingLog(), 0))
+        finally:
+            storage.close()
+            storage.unlink()
+
+    def test_reset(self):
+        policy = compile_limitations('1/minute')
+
+        for key in 'tenant-1', 'tenant-2', 'other':
+            self.storage.acquire(key, policy, SlidingLog(), 0)
+
+        self.storage.reset('other')
+
+        self.assertTrue(self.storage.peek('other', policy, SlidingLog(), 0))
+        self.assertEqual(2, self.storage.reset_matching('tenant-*'))
+        self.assertTrue(self.storage.peek('tenant-1', policy, SlidingLog(), 0))
+
+    def test_slot_size(self):
+        policy = compile_limitations('128/hour')
+
+        for i in range(128):
+            self.assertEqual((True, None), self.storage.acquire('key', policy, SlidingLog(), i))
+
+        with self.assertRaises(ValueError):
+            self.storage.acquire('key', compile_limitations('129/hour'), SlidingLog(), 128)
+
+        self.assertFalse(self.storage.peek('key', compile_limitations('128/hour'), SlidingLog(), 128))
+        self.assertEqual((True, None), self.storage.acquire('other', compile_limitations('1000/hour'), GCRA(), 0))
+
+        with self.assertRaises(ValueError):
+            SharedMemoryStorage(self.storage.memory.name, slots=128)
+
+
+class TestMappedFileStorage(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'limiter.state')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_warm_restart(self):
+        clock = VirtualClock(time.time_ns())
+        storage = MappedFileStorage(self.path, slots=64)
+
+        for strategy in SlidingLog(), FixedWindow(), SlidingWindow(), GCRA():
+            func = Limiter(storage=storage, strategy=strategy, clock=clock).limit('3/minute', strategy.name)(
+                lambda: True
+            )
+
+            for _ in range(3):
+                func()
+
+        storage.flush()
+        storage.close()
+        storage = MappedFileStorage(self.path, slots=64)
+
+        for strategy in SlidingLog(), FixedWindow(), SlidingWindow(), GCRA():
+            func = Limiter(storage=storage, strategy=strategy, clock=clock).limit('3/minute', strategy.name)(
+                lambda: True
+            )
+
+            with self.assertRaises(RateLimitExceeded):
+                func()
+
+        self.assertEqual(4, storage.reset_matching('*'))
+
+        storage.close()
+
+    def test_layout(self):
+        MappedFileStorage(self.path, slots=64).close()
+
+        self.assertEqual(64 + 64 * MappedFileStorage.slot_stride(1024, 64), os.path.getsize(self.path))
+
+        with self.assertRaises(ValueError):
+            MappedFileStorage(self.path, slots=128)
+
+    def test_slot_overflow(self):
+        storage = MappedFileStorage(self.path, slots=64)
+        func = Limiter(storage=storage).limit('1000/hour', 'key')(lambda: True)
+
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                func()
+
+        self.assertTrue(Limiter(storage=storage).limit('128/hour', 'key')(lambda: True)())
+        storage.close()
+
+
+def sqlite_worker(path, permitted):
+    limiter = Limiter(storage=SQLiteStorage(path))
+
+    @limiter.limit('50/minute', 'sqlite-key')
+    def func():
+        pass
+
+    for _ in range(20):
+        with suppress(RateLimitExceeded):
+            func()
+
+            with permitted.get_lock():
+                permitted.value += 1
+
+
+class TestSQLiteStorage(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'limiter.db')
+        self.storage = SQLiteStorage(self.path)
+
+    def tearDown(self):
+        self.storage.close()
+        self.directory.cleanup()
+
+    def test_multiple_processes(self):
+        permitted = Value('i', 0)
+        processes = [Process(target=sqlite_worker, args=(self.path, permitted)) for _ in range(4)]
+
+        for process in processes:
+            process.start()
+
+        for process in processes:
+            process.join()
+
+        self.assertEqual(50, permitted.value)
+
+    def test_persistence(self):
+        policy = compile_limitations('2/day')
+        now = self.storage.clock()
+
+        for strategy in SlidingLog(), FixedWindow(), SlidingWindow(), GCRA():
+            for _ in range(2):
+                self.assertTrue(self.storage.acquire(strategy.name, policy, strategy, now)[0])
+
+        self.storage.close()
+        storage = SQLiteStorage(self.path)
+
+        for strategy in SlidingLog(), FixedWindow(), SlidingWindow(), GCRA():
+            self.assertFalse(storage.peek(strategy.name, policy, strategy, now))
+            self.assertFalse(storage.acquire(strategy.name, policy, strategy, now)[0])
+
+        storage.close()
+
+    def test_reset(self):
+        policy = compile_limitations('1/minute')
+
+        for key in 'tenant-1', 'tenant-2', 'tenant-3', 'other':
+            self.storage.acquire(key, policy, SlidingLog(), 0)
+
+        self.storage.reset('other')
+        self.storage.reset_many(['tenant-3'])
+
+        self.assertTrue(self.storage.peek('other', policy, SlidingLog(), 0))
+        self.assertTrue(self.storage.peek('tenant-3', policy, SlidingLog(), 0))
+        self.assertEqual(2, self.storage.reset_matching('tenant-*'))
+        self.assertTrue(self.storage.peek('tenant-1', policy, SlidingLog(), 0))
+
+    def test_prune(self):
+        storage = SQLiteStorage(self.path, prune_interval=1)
+        policy = compile_limitations('1/second')
+
+        storage.acquire('first', policy, SlidingLog(), second)
+        storage.acquire('second', policy, SlidingLog(), 3 * second)
+
+        connection = sqlite3.connect(self.path)
+        self.assertEqual([('second',)], connection.execute('SELECT key FROM function_limiter').fetchall())
+        connection.close()
+        storage.close()
+
+
+class TestStateTransfer(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+        storage = redis.Redis()
+        for name in storage.scan_iter('state-transfer:*'):
+            storage.delete(name)
+
+    def storages(self):
+        return [
+            MemoryStorage(),
+            RedisStorage(redis.Redis(), database_name='state-transfer'),
+            SQLiteStorage(os.path.join(self.directory.name, 'limiter.db')),
+            MappedFileStorage(os.path.join(self.directory.name, 'limiter.state'), slots=64),
+        ]
+
+    def test_transfer(self):
+        for strategy in SlidingLog(), FixedWindow(), SlidingWindow(), GCRA():
+            for source in self.storages():
+                for target in self.storages():
+                    source.reset('key')
+                    target.reset('key')
+                    limiter = Limiter(storage=source, strategy=strategy, clock=VirtualClock(source.clock()))
+
+                    for _ in range(2):
+                        limiter.limit('3/hour', 'key')(lambda: True)()
+
+                    file = io.BytesIO()
+                    file.writelines(limiter.export_state())
+                    file.seek(0)
+
+                    limiter = Limiter(storage=target, strategy=strategy, clock=VirtualClock(target.clock()))
+                    limiter.import_state(read_records(file))
+                    func = limiter.limit('3/hour', 'key')(lambda: True)
+
+                    func()
+
+                    with self.assertRaises(RateLimitExceeded):
+                        func()
+
+    def test_mixed_strategies(self):
+        names = ['sliding-log', 'fixed-window', 'sliding-window', 'gcra']
+
+        for source in self.storages():
+            for target in self.storages():
+                source.reset_many(names)
+                target.reset_many(names)
+                limiter = Limiter(storage=source, clock=VirtualClock(source.clock()))
+
+                for name in names:
+                    for _ in range(2):
+                        limiter.limit('3/hour', name, strategy=name)(lambda: True)()
+
+                records = list(limiter.export_state())
+                gcra = list(limiter.export_state('gcra'))
+
+                self.assertEqual(4, len(records))
+                self.assertEqual(1, len(gcra))
+
+                limiter = Limiter(storage=target, clock=VirtualClock(target.clock()))
+                limiter.import_state(records)
+
+                for name in names:
+                    func = limiter.limit('3/hour', name, strategy=name)(lambda: True)
+                    func()
+
+                    with self.assertRaises(RateLimitExceeded):
+                        func()
+
+    def test_truncated_keys(self):
+        storage = MappedFileStorage(os.path.join(self.directory.name, 'limiter.state'), slots=64, key_size=16)
+        limiter = Limiter(storage=storage)
+
+        for key in 'tenant-0123456789-a', 'tenant-0123456789-b', 'short-key':
+            limiter.limit('1/minute', key)(lambda: True)()
+
+        records = list(limiter.export_state())
+        target = Limiter()
+        target.import_state(records)
+
+        self.assertEqual(['short-key'], list(target.logs))
+        storage.close()
+
+    def test_expired_keys(self):
+        clock = VirtualClock()
+        limiter = Limiter(clock=clock)
+
+        limiter.limit('1/second', 'first')(lambda: True)()
+        clock.advance(1)
+        limiter.limit('1/minute', 'second')(lambda: True)()
+
+        records = list(limiter.export_state())
+
+        self.assertEqual(1, len(records))
+
+        limiter = Limiter(clock=VirtualClock(10 ** 6 * second))
+        limiter.import_state(records)
+
+        self.assertEqual(['second'], list(limiter.logs))
+        self.assertEqual([10 ** 6 * second], list(limiter.logs['second']))
+
+
+class TestFallbackStorage(TestCase):
+    def test_fallback(self):
+        storage = FallbackStorage(UnhealthyStorage(), share=0.5, interval=0.01)
+        limiter = Limiter(storage=storage)
+
+        @limiter.limit('4/minute', 'key')
+        def func():
+            pass
+
+        for _ in range(2):
+            func()
+
+        self.assertTrue(storage.tripped)
+
+        with self.assertRaises(RateLimitExceeded):
+            func()
+
+        storage.storage.down = False
+        time.sleep(0.1)
+
+        self.assertFalse(storage.tripped)
+
+        for _ in range(10):
+            func()
+
+    def test_latency_budget(self):
+        storage = FallbackStorage(UnhealthyStorage(delay=0.02), share=1, budget=0.01, interval=10)
+        storage.storage.down = False
+        limiter = Limiter(storage=storage)
+
+        @limiter.limit('1/minute', 'key')
+        def func():
+            pass
+
+        func()
+
+        self.assertTrue(storage.tripped)
+
+        func()
+
+        with self.assertRaises(RateLimitExceeded):
+            func()
+
+    def test_reset(self):
+        storage = FallbackStorage(UnhealthyStorage(), share=0.5, interval=10)
+        limiter = Limiter(storage=storage)
+        func = limiter.limit('2/minute', 'key')(lambda: True)
+
+        limiter.reset('key')
+
+        self.assertTrue(storage.tripped)
+
+        func()
+
+        with self.assertRaises(RateLimitExceeded):
+            func()
+
+        limiter.reset('key')
+        limiter.reset_many(['key'])
+        func()
+
+        self.assertEqual(1, limiter.reset_matching('k*'))
+        self.assertTrue(func())
+
+    def test_share(self):
+        for share in 0, -0.5, 1.5:
+            with self.assertRaises(ValueError):
+                FallbackStorage(UnhealthyStorage(), share=share)
+
+        with self.assertRaises(TypeError):
+            FallbackStorage(UnhealthyStorage())
+
+
+class TestAsyncLimiter(IsolatedAsyncioTestCase):
+    async def test_async_limiter(self):
+        limiter = Limiter()
+
+        @limiter.limit('3/minute', 'key')
+        async def func():
+            await asyncio.sleep(0.5)
+
+        i = 0
+        with suppress(RateLimitExceeded):
+            for i in range(10):
+                await func()
+
+        self.assertEqual(3, i)
+
+    async def test_async_redis_limiter(self):
+        storage = redis.asyncio.Redis()
+        limiter = Limiter(
+            redis_storage=storage
+        )
+
+        @limiter.limit('3/minute', 'async-key')
+        async def func():
+            pass
+
+        i = 0
+
+        with self.assertRaises(RateLimitExceeded):
+            for i in range(4):
+                await func()
+
+        self.assertEqual(3, i)
+
+        await limiter.reset('async-key')
+        await func()
+        await limiter.reset('async-key')
+        await storage.aclose()
+
+    async def test_async_redis_invalidation(self):
+        storages = [AsyncRedisStorage(redis.asyncio.Redis(), lease=0.5, invalidation=True) for _ in range(2)]
+        policy = compile_limitations('100/hour')
+        now = storages[0].clock()
+
+        for _ in range(5):
+            await storages[0].acquire('async-invalidation-key', policy, FixedWindow(), now + 1)
+
+        await asyncio.sleep(0.1)
+        await storages[1].reset('async-invalidation-key')
+        await asyncio.sleep(0.1)
+
+        self.assertNotIn('async-invalidation-key', storages[0]._leases)
+
+        for storage in storages:
+            storage.close()
+
+    async def test_async_redis_reset_matching(self):
+        storage = redis.asyncio.Redis()
+        limiter = Limiter(redis_storage=storage)
+        functions = [limiter.limit('1/minute', 'async-tenant-{}'.format(i))(self.coroutine) for i in range(3)]
+
+        for func in functions:
+            await func()
+
+        self.assertEqual(3, await limiter.reset_matching('async-tenant-*'))
+
+        for func in functions:
+            await func()
+
+        await limiter.reset_many(['async-tenant-{}'.format(i) for i in range(3)])
+
+        for func in functions:
+            await func()
+
+        await limiter.reset_matching('async-tenant-*')
+        await storage.aclose()
+
+    @staticmethod
+    async def coroutine():
+        pass
+
+    async def test_async_redis_state_transfer(self):
+        storage = redis.asyncio.Redis()
+        limiter = Limiter(redis_storage=storage, strategy='gcra')
+        func = limiter.limit('2/minute', 'async-transfer-key')(self.coroutine)
+
+        await func()
+
+        records = [record async for record in limiter.export_state()]
+        await limiter.reset('async-transfer-key')
+        await limiter.import_state(records)
+        await func()
+
+        with self.assertRaises(RateLimitExceeded):
+            await func()
+
+        await limiter.reset('async-transfer-key')
+        await storage.aclose()
+
+    async def test_async_lease_expiry(self):
+        client = redis.asyncio.Redis()
+        storage = AsyncRedisStorage(client, lease=0.5, lease_ttl=0.05)
+        func = Limiter(storage=storage, strategy='fixed-window').limit('100/hour', 'async-lease-key')(self.coroutine)
+
+        for _ in range(10):
+            await func()
+
+        self.assertTrue(storage._leases)
+
+        await asyncio.sleep(0.3)
+
+        self.assertFalse(storage._leases)
+        self.assertEqual(10, int(await client.hget('function-limiter:{async-lease-key}', '3600000000:count')))
+
+        await storage.reset('async-lease-key')
+        await client.aclose()
+
+    async def test_async_fallback_reset(self):
+        storage = AsyncFallbackStorage(AsyncUnhealthyStorage(), share=1, interval=10)
+        limiter = Limiter(storage=storage)
+
+        await limiter.reset('key')
+        await limiter.reset_many(['key'])
+
+        self.assertTrue(storage.tripped)
+        self.assertEqual(0, await limiter.reset_matching('k*'))
+
+        storage._probe.cancel()
+
+    async def test_async_fallback(self):
+        storage = AsyncFallbackStorage(AsyncUnhealthyStorage(delay=1), share=1, budget=0.01, interval=0.01)
+        limiter = Limiter(storage=storage)
+
+        @limiter.limit('1/minute', 'key')
+        async def func():
+            pass
+
+        await asyncio.wait_for(func(), 0.5)
+
+        self.assertTrue(storage.tripped)
+
+        with self.assertRaises(RateLimitExceeded):
+            await func()
+
+        storage.storage.delay = 0
+        storage.storage.down = False
+        await asyncio.sleep(0.1)
+
+        self.assertFalse(storage.tripped)
+
+    def test_async_redis_synchronous_function(self):
+        limiter = Limiter(
+            redis_storage=redis.asyncio.Redis()
+        )
+
+        with self.assertRaises(TypeError):
+            @limiter.limit('3/minute', 'async-key')
+            def func():
+                pass